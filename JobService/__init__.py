@@ -29,6 +29,8 @@ SLS_SYSTEM = prefix + '/share/jobservice/sls/{0}.xml'
 SLS_DEFAULT = prefix + '/share/jobservice/default/{0}.xml'
 SLS_LOCAL = None
 
+CACHE_DIR = '/var/cache/jobservice'
+
 class JobException(DBusException):
     _dbus_error_name = DBUS_IFACE + '.JobException'
     
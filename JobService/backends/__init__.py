@@ -14,19 +14,43 @@
 # You should have received a copy of the GNU General Public License
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
 import logging
 from re import search
+from time import time
 from subprocess import Popen, PIPE
 from dbus import Array
-from JobService.settings import ServiceSettings
+from JobService.settings import ServiceSettings, save_compiled, \
+        write_changes, run_helpers, save_files, restore_files
+from JobService.util import parallel_map
+from JobService import cache, JobException
+import JobService
 
 log = logging.getLogger('backends')
 
 BACKENDS = []   # automatic if empty
                 # distributors can manually set this for efficiency
 
+WORKERS = 4     # threads used for discovery; 1 disables parallel discovery
+
 class ServiceBase:
     
+    services_changed = None     # callback given to watch_services
+    
+    def __init__(self, snapshot=None):
+        pass
+    
+    def get_snapshot(self):
+        """
+        Return picklable state to pass back as 'snapshot' to the constructor
+        on the next start, or None if this backend must always be queried.
+        
+        Snapshots are only used while the files in SNAPSHOT_PATHS are
+        unchanged, so only state derived from those files belongs here.
+        """
+        return None
+    
     def get_all_services(self):
         return []
     
@@ -37,6 +61,7 @@ class ServiceBase:
             'version': '0',
             'author': 'Nobody',
             'running': False,
+            'status': 'stopped',
             'automatic': False,
             'pid': 0,
             'starton': Array(signature='s'),
@@ -44,6 +69,45 @@ class ServiceBase:
             'file': '',
         }
     
+    def get_service_info(self, name):
+        """
+        Return the properties of a service that only change along with its
+        files. Backends should override this and get_service_state if
+        running state is more expensive to find than the rest.
+        """
+        info = self.get_service(name)
+        del info['running']
+        del info['status']
+        del info['pid']
+        return info
+    
+    def get_service_state(self, name):
+        """
+        Return the volatile 'running', 'status' and 'pid' properties of a
+        service. 'status' is one of running, stopped or unknown.
+        """
+        info = self.get_service(name)
+        return {'running': info['running'], 'status': info['status'],
+                'pid': info['pid']}
+    
+    def get_service_stamp(self, name, info):
+        """
+        Return a value that changes whenever the sources of a service's
+        info, as returned by get_service_info, may have changed. Backends
+        reading more than the service's file should override this.
+        """
+        return cache.stamp([info.get('file', '')])
+    
+    def get_services(self, names):
+        """
+        Return a dictionary of get_service results for several services.
+        Backends that can gather information in bulk should override this.
+        """
+        infos = {}
+        for name in names:
+            infos[name] = self.get_service(name)
+        return infos
+    
     def start_service(self, name):
         pass
     
@@ -53,6 +117,14 @@ class ServiceBase:
     def set_service_automatic(self, name, auto):
         pass
     
+    def set_services_automatic(self, changes):
+        """
+        Apply a list of (name, auto) changes. Backends that can enable and
+        disable several services at once should override this.
+        """
+        for name, auto in changes:
+            self.set_service_automatic(name, auto)
+    
     def get_service_settings(self, name, lang):
         return []
     
@@ -61,6 +133,41 @@ class ServiceBase:
 
     def validate_service_setting(self, name, setting, value):
         pass
+    
+    def get_stats(self):
+        """Return a dictionary of counters worth keeping an eye on."""
+        return {}
+    
+    def get_service_depends(self, name, stop=False):
+        """
+        Return (provides, before, after) for ordering a start (or stop) of
+        several services: other names the service can be referred to by,
+        and names that must be started (or stopped) before and after it.
+        """
+        return ([], [], [])
+    
+    def watch(self, callback):
+        """
+        Call callback(names) from the main loop whenever services may have
+        changed outside of our control. A name can also be an Upstart job
+        name, standing for all of the job's instances.
+        """
+        pass
+    
+    def watch_services(self, callback):
+        """
+        Call callback(added, removed) with lists of service names whenever
+        services appear or disappear after get_all_services.
+        This may be called from any thread.
+        """
+        self.services_changed = callback
+    
+    def _publish(self, old, new):
+        """Report service names that came or went between old and new."""
+        added = sorted(new - old)
+        removed = sorted(old - new)
+        if (added or removed) and self.services_changed:
+            self.services_changed(added, removed)
 
 class ServiceProxy(ServiceBase):
     """
@@ -68,53 +175,213 @@ class ServiceProxy(ServiceBase):
     to do the heavy lifting.
     """
     
-    def __init__(self):
+    def __init__(self, workers=WORKERS):
         """
         Load the appropriate backends for the current system.
+        
+        Backends are loaded and enumerated using up to 'workers' threads,
+        as they generally don't depend on each other.
         """
         self.backends = []
         self.bkmap = {}
         self.sls = {}
         self.bksls = {}
+        self.workers = workers
+        self.timings = {}
+        self.found = {}
+        
+        # a snapshot of a previous run lets us skip most of the discovery
+        self.snapkey = cache.stamp(_snapshot_paths())
+        self.snapshot = cache.load_snapshot('inventory', self.snapkey)
         
         if BACKENDS:
             load = BACKENDS
             log.debug('Backends set to: ' + ', '.join(load))
+        elif self.snapshot:
+            load = self.snapshot['backends']
+            log.debug('Backends from snapshot: ' + ', '.join(load))
         else:
             load = _auto_backends()
             log.debug('Autoloading backends: ' + ', '.join(load))
+        if self.snapshot and self.snapshot['backends'] != load:
+            self.snapshot = None
         
         # load the backends
-        for mod in load:
-            newmod = __import__('JobService.backends.' + mod,
-                    fromlist=['ServiceBackend'])
-            self.backends.append(newmod.ServiceBackend())
+        self.bknames = load
+        self.backends = parallel_map(self._load_backend, load, self.workers)
+    
+    def _load_backend(self, mod):
+        start = time()
+        newmod = __import__('JobService.backends.' + mod,
+                fromlist=['ServiceBackend'])
+        state = None
+        if self.snapshot:
+            state = self.snapshot['state'].get(mod)
+        bk = newmod.ServiceBackend(snapshot=state)
+        log.debug('Loaded {0} in {1:.3f}s'.format(mod, time() - start))
+        return bk
         
     def get_all_services(self):
         svclist = []
-        # get the services
-        for bk in self.backends:
-            services = bk.get_all_services()
+        # get the services from every backend at once
+        found = parallel_map(self._enumerate_backend, self.backends,
+                self.workers)
+        # merge in backend order (later backends will still properly override)
+        for name, bk, services in zip(self.bknames, self.backends, found):
+            self.found[name] = services
             for svc in services:
                 self.bkmap[svc] = bk
-                # check for SLS
-                try:
-                    self.sls[svc] = ServiceSettings(svc)
-                except: pass
-                # and query the backend for additional settings
-                self.bksls[svc] = bk.get_service_settings(svc, '')
-                # no duplicates (backends will still properly override)
+                # no duplicates
                 if not svc in svclist:
                     svclist.append(svc)
+        # load settings for all of the services
+        loaded = parallel_map(self._load_settings, svclist, self.workers)
+        for svc, (sls, bksls) in zip(svclist, loaded):
+            if sls:
+                self.sls[svc] = sls
+            self.bksls[svc] = bksls
+        if not self.snapshot:
+            self.save_snapshot()
+        save_compiled()
         return svclist
     
+    def save_snapshot(self):
+        """Store what we know about the system for the next start."""
+        data = {
+            'backends': self.bknames,
+            'state': {},
+            'services': {},
+            'sls': {},
+            'bksls': {},
+        }
+        for name, bk in zip(self.bknames, self.backends):
+            state = bk.get_snapshot()
+            if state is None:
+                continue
+            data['state'][name] = state
+            data['services'][name] = self.found[name]
+            for svc in self.found[name]:
+                data['sls'][svc] = self.sls[svc].filename if svc in self.sls else None
+                data['bksls'][svc] = self.bksls[svc]
+        cache.save_snapshot('inventory', self.snapkey, data)
+        self.snapshot = data
+    
+    def _enumerate_backend(self, bk):
+        start = time()
+        name = _backend_name(bk)
+        if self.snapshot and name in self.snapshot['services']:
+            services = self.snapshot['services'][name]
+        else:
+            services = bk.get_all_services()
+        self.timings[name] = time() - start
+        log.debug('Found {0} jobs in {1} in {2:.3f}s'.format(len(services),
+                name, self.timings[name]))
+        return services
+    
+    def _load_settings(self, svc):
+        """Return (SLS, backend settings) for a service."""
+        if self.snapshot and svc in self.snapshot['sls']:
+            filename = self.snapshot['sls'][svc]
+            try:
+                sls = ServiceSettings(svc, filename) if filename else None
+            except:
+                sls = None
+            return (sls, self.snapshot['bksls'][svc])
+        # check for SLS
+        try:
+            sls = ServiceSettings(svc)
+        except:
+            sls = None
+        # and query the backend for additional settings
+        return (sls, self.bkmap[svc].get_service_settings(svc, ''))
+    
     def get_service(self, name):
-        bk = self.bkmap[name]
-        info = {'backend': bk.__module__[bk.__module__.rfind('.')+1:],
+        return self._service_info(name, self.bkmap[name].get_service(name))
+    
+    def get_service_info(self, name):
+        return self._service_info(name,
+                self.bkmap[name].get_service_info(name))
+    
+    def get_service_state(self, name):
+        return self.bkmap[name].get_service_state(name)
+    
+    def get_service_stamp(self, name, info):
+        return self.bkmap[name].get_service_stamp(name, info)
+    
+    def get_services(self, names):
+        """
+        Gather service information with one call to each backend. If a
+        backend fails, its services are asked for one by one, and those
+        that still fail are left out.
+        """
+        groups = {}
+        for name in names:
+            groups.setdefault(self.bkmap.get(name), []).append(name)
+        groups.pop(None, None)
+        infos = {}
+        for bk, bknames in groups.iteritems():
+            try:
+                results = bk.get_services(bknames)
+            except Exception, e:
+                log.warn('Unable to list {0} services: {1}'.format(
+                        _backend_name(bk), e))
+                results = {}
+                for name in bknames:
+                    try:
+                        results[name] = bk.get_service(name)
+                    except Exception, e:
+                        log.debug('Unable to load {0}: {1}'.format(name, e))
+            for name, props in results.iteritems():
+                try:
+                    infos[name] = self._service_info(name, props)
+                except KeyError:
+                    # removed while we were asking
+                    pass
+        return infos
+    
+    def _service_info(self, name, props):
+        """Add proxy-level information to a backend's service properties."""
+        info = {'backend': _backend_name(self.bkmap[name]),
                 'settings': name in self.sls or len(self.bksls[name])}
-        info.update(bk.get_service(name))
+        info.update(props)
         return info
     
+    def watch(self, callback):
+        for bk in self.backends:
+            bk.watch(callback)
+    
+    def watch_services(self, callback):
+        for bk in self.backends:
+            bk.watch_services(self._services_changed(bk, callback))
+    
+    def _services_changed(self, bk, callback):
+        """Return a handler for services of bk appearing or disappearing."""
+        def changed(added, removed):
+            for svc in removed:
+                if self.bkmap.get(svc) is bk:
+                    del self.bkmap[svc]
+                    self.sls.pop(svc, None)
+                    self.bksls.pop(svc, None)
+            for svc in added:
+                self.bkmap[svc] = bk
+                sls, bksls = self._load_settings(svc)
+                if sls:
+                    self.sls[svc] = sls
+                self.bksls[svc] = bksls
+            log.debug('Jobs added: {0}; removed: {1}'.format(
+                    ', '.join(added), ', '.join(removed)))
+            callback(added, removed)
+        return changed
+    
+    def get_stats(self):
+        """Return discovery timings and counters from all backends."""
+        stats = {}
+        for name, seconds in self.timings.iteritems():
+            stats[name + '_enumerate_seconds'] = seconds
+        for bk in self.backends:
+            stats.update(bk.get_stats())
+        return stats
+    
     def start_service(self, name):
         self.bkmap[name].start_service(name)
         log.info("Started {0}".format(name))
@@ -127,14 +394,27 @@ class ServiceProxy(ServiceBase):
         self.bkmap[name].set_service_automatic(name, auto)
         log.info("Set {0} to {1}".format(name, 'auto' if auto else 'manual'))
     
+    def set_services_automatic(self, changes):
+        """Apply (name, auto) changes with one call to each backend."""
+        groups = []
+        for name, auto in changes:
+            bk = self.bkmap[name]
+            if not groups or groups[-1][0] is not bk:
+                groups.append((bk, []))
+            groups[-1][1].append((name, auto))
+        for bk, bkchanges in groups:
+            bk.set_services_automatic(bkchanges)
+            for name, auto in bkchanges:
+                log.info("Set {0} to {1}".format(name,
+                        'auto' if auto else 'manual'))
+    
     def get_service_settings(self, name, lang=''):
         settings = []
         snames = []
         # xml settings
         if name in self.sls:
-            for s in self.sls[name].get_all_settings():
-                settings.append(self.sls[name].get_setting(s, lang))
-                snames.append(s)
+            snames = self.sls[name].get_all_settings()
+            settings = self.sls[name].get_settings(snames, lang)
         # settings added by backend
         for s in self.bkmap[name].get_service_settings(name, lang):
             if not s[0] in snames:
@@ -142,16 +422,67 @@ class ServiceProxy(ServiceBase):
         return settings
     
     def set_service_settings(self, name, newsettings):
+        self.set_services_settings([(name, newsettings)])
+    
+    def set_services_settings(self, changes):
+        """
+        Store settings for several services, given as a list of (name,
+        {setting: value}). SLS files shared by the services are rewritten
+        once for all of them. Returns the original contents of the files
+        rewritten, for restore_files; if storing fails, they are put back
+        before the error is raised.
+        """
         # validate *all* settings before applying *any*
-        for s in newsettings:
-            self.validate_service_setting(name, s, newsettings[s])
+        for name, newsettings in changes:
+            for s in newsettings:
+                self.validate_service_setting(name, s, newsettings[s])
         # if no exception occurred, we're good
-        if name in self.sls:
-            for s in self.sls[name].get_all_settings():
-                if s in newsettings:
-                    self.sls[name].set_setting(s, newsettings.pop(s))
-        # send the leftover settings to the backend
-        self.bkmap[name].set_service_settings(name, newsettings)
+        files, order, helpers, leftovers = self._plan_settings(changes)
+        saved = save_files(order)
+        try:
+            write_changes(files, order)
+            self._set_elsewhere(helpers, leftovers)
+        except Exception:
+            err = sys.exc_info()
+            restore_files(saved)
+            raise err[0], err[1], err[2]
+        return saved
+    
+    def _plan_settings(self, changes):
+        """
+        Sort settings into SLS file rules and set helper calls, leaving
+        the ones SLS doesn't know about for the backends.
+        """
+        files = {}
+        order = []
+        helpers = []
+        leftovers = []
+        for name, newsettings in changes:
+            newsettings = dict(newsettings)
+            if name in self.sls:
+                sls_changes = []
+                for s in self.sls[name].get_all_settings():
+                    if s in newsettings:
+                        sls_changes.append((s, newsettings.pop(s)))
+                self.sls[name].add_changes(sls_changes, files, order, helpers)
+            leftovers.append((name, newsettings))
+        return (files, order, helpers, leftovers)
+    
+    def _set_elsewhere(self, helpers, leftovers):
+        """Run set helpers, then send leftover settings to the backends."""
+        run_helpers(helpers)
+        for name, newsettings in leftovers:
+            self.bkmap[name].set_service_settings(name, newsettings)
+    
+    def _undo_settings(self, saved, old):
+        """
+        Put rewritten files back byte for byte, then give the old values
+        in 'old' to the set helpers and backends, which can't be restored
+        any other way. Nothing is written to files from 'old'.
+        """
+        restore_files(saved)
+        files, order, helpers, leftovers = self._plan_settings(old)
+        self._set_elsewhere(helpers, leftovers)
 
     def validate_service_setting(self, name, setting, value):
         # verify by provided SLS if available
@@ -161,10 +492,238 @@ class ServiceProxy(ServiceBase):
         else:
             return self.bkmap[name].validate_service_setting(name, setting, value)
     
+    def plan_changes(self, changes):
+        """
+        Validate a list of (name, operation, arguments) changes before
+        making any of them, returning the steps for apply_changes.
+        
+        Operations are start, stop, automatic (with an argument 'automatic'
+        of true or false) and settings (with the new settings as arguments).
+        All settings changes for a service are merged into one step, and
+        apply_changes writes runs of settings steps together, so a file
+        shared by several services is only rewritten once.
+        """
+        steps = []
+        settings = {}
+        for name, op, args in changes:
+            if name not in self.bkmap:
+                raise JobException('No such job: {0}'.format(name))
+            if op in ('start', 'stop'):
+                steps.append((name, op, None))
+            elif op == 'automatic':
+                if args.get('automatic') not in ('true', 'false'):
+                    raise JobException('Invalid automatic value for {0}.'.format(name))
+                steps.append((name, op, args['automatic'] == 'true'))
+            elif op == 'settings':
+                for s in args:
+                    self.validate_service_setting(name, s, args[s])
+                if name not in settings:
+                    settings[name] = {}
+                    steps.append((name, op, settings[name]))
+                settings[name].update(args)
+            else:
+                raise JobException('Unknown operation: {0}'.format(op))
+        return steps
+    
+    def apply_changes(self, steps):
+        """
+        Apply steps from plan_changes in order. If one fails, the steps
+        already applied are undone in reverse order and the error raised.
+        """
+        undo = []
+        try:
+            for name, op, arg in _batch_steps(steps):
+                undo.append(self._apply_change(name, op, arg))
+        except Exception:
+            err = sys.exc_info()
+            log.warn('Change to {0} failed, rolling back'.format(name))
+            for func, args in reversed(undo):
+                try:
+                    func(*args)
+                except Exception, e:
+                    log.error('Unable to roll back {0}: {1}'.format(
+                            func.__name__, e))
+            raise err[0], err[1], err[2]
+    
+    def _apply_change(self, name, op, arg):
+        """Apply a single change, returning (func, args) to undo it."""
+        if op == 'start':
+            running = self.get_service_state(name)['running']
+            self.start_service(name)
+            return (self.stop_service if not running else _noop, (name,))
+        elif op == 'stop':
+            running = self.get_service_state(name)['running']
+            self.stop_service(name)
+            return (self.start_service if running else _noop, (name,))
+        elif op == 'automatic':
+            old = [(n, self.get_service_info(n)['automatic']) for n, a in arg]
+            try:
+                self.set_services_automatic(arg)
+            except Exception:
+                # part of the batch may have been applied already
+                err = sys.exc_info()
+                try:
+                    self.set_services_automatic(old)
+                except Exception, e:
+                    log.error('Unable to roll back {0}: {1}'.format(name, e))
+                raise err[0], err[1], err[2]
+            return (self.set_services_automatic, (old,))
+        elif op == 'settings':
+            old = []
+            for n, newsettings in arg:
+                values = {}
+                for s in self.get_service_settings(n):
+                    if s[0] in newsettings:
+                        values[s[0]] = s[3]
+                old.append((n, values))
+            try:
+                saved = self.set_services_settings(arg)
+            except Exception:
+                # the files are back already, but helpers may have run
+                err = sys.exc_info()
+                try:
+                    self._undo_settings({}, old)
+                except Exception, e:
+                    log.error('Unable to roll back {0}: {1}'.format(name, e))
+                raise err[0], err[1], err[2]
+            return (self._undo_settings, (saved, old))
+    
+    def start_services(self, names):
+        """
+        Start several services, honoring dependencies between them.
+        Returns a list of (name, success, message, seconds taken).
+        """
+        return self._run_ordered(names, self.start_service, False)
+    
+    def stop_services(self, names):
+        """Stop several services. Returns the same as start_services."""
+        return self._run_ordered(names, self.stop_service, True)
+    
+    def _order(self, names, stop):
+        """
+        Sort services into waves, where each wave only depends on earlier
+        ones. Returns (waves, required, loops): required maps each name to
+        the names it waits on, and loops are names in a dependency loop.
+        Services that only wait on a loop are still put in a wave.
+        """
+        provider = {}
+        depends = {}
+        required = {}
+        for name in names:
+            depends[name] = self.bkmap[name].get_service_depends(name, stop)
+            required[name] = set()
+            for p in [name] + depends[name][0]:
+                provider.setdefault(p, name)
+        for name in names:
+            provides, before, after = depends[name]
+            for b in before:
+                if provider.get(b, name) != name:
+                    required[name].add(provider[b])
+            for a in after:
+                if provider.get(a, name) != name:
+                    required[provider[a]].add(name)
+        waves = []
+        loops = []
+        waiting = dict((n, set(r)) for n, r in required.iteritems())
+        while waiting:
+            wave = sorted(n for n, r in waiting.iteritems() if not r)
+            if wave:
+                waves.append(wave)
+            else:
+                # everything left waits on a loop; take the loops out
+                wave = _in_cycles(waiting)
+                loops += wave
+            for n in wave:
+                del waiting[n]
+            for r in waiting.itervalues():
+                r.difference_update(wave)
+        return (waves, required, sorted(loops))
+    
+    def _run_ordered(self, names, action, stop):
+        """Call action on services in dependency order, wave by wave."""
+        names = sorted(set(names))
+        waves, required, loops = self._order(names, stop)
+        failed = set(loops)
+        results = []
+        def run(name):
+            if required[name] & failed:
+                return (name, False, 'A dependency failed.', 0.0)
+            start = time()
+            try:
+                action(name)
+            except Exception, e:
+                return (name, False, str(e), time() - start)
+            return (name, True, '', time() - start)
+        for wave in waves:
+            for result in parallel_map(run, wave, self.workers):
+                if not result[1]:
+                    failed.add(result[0])
+                results.append(result)
+        for name in loops:
+            results.append((name, False, 'Dependency loop.', 0.0))
+        return results
+    
+
+def _noop(*args):
+    pass
+
+def _in_cycles(graph):
+    """
+    Return the names in graph, which maps each name to the names it waits
+    on, that wait on themselves through a loop.
+    """
+    cycles = []
+    for name in graph:
+        seen = set()
+        stack = list(graph[name])
+        while stack:
+            n = stack.pop()
+            if n == name:
+                cycles.append(name)
+                break
+            if n in graph and n not in seen:
+                seen.add(n)
+                stack.extend(graph[n])
+    return sorted(cycles)
+
+def _batch_steps(steps):
+    """
+    Merge runs of automatic steps into one step with a list of (name, auto)
+    changes, and runs of settings steps into one with a list of (name,
+    settings), so they can be applied together.
+    """
+    batched = []
+    for name, op, arg in steps:
+        if op not in ('automatic', 'settings'):
+            batched.append((name, op, arg))
+        elif batched and batched[-1][1] == op:
+            prev = batched.pop()
+            batched.append((prev[0] + ', ' + name, op, prev[2] + [(name, arg)]))
+        else:
+            batched.append((name, op, [(name, arg)]))
+    return batched
+
+def _backend_name(bk):
+    """Return the short module name of a backend instance."""
+    return bk.__module__[bk.__module__.rfind('.')+1:]
+
+def _snapshot_paths():
+    """Return the paths that a snapshot of the job inventory depends on."""
+    paths = ['/sbin/init', '/etc/init.d', '/etc/init']
+    for runlevel in ('0', '1', '2', '3', '4', '5', '6', '7', 'S'):
+        paths.append('/etc/rc{0}.d'.format(runlevel))
+    for loc in (JobService.SLS_LOCAL, JobService.SLS_SYSTEM, JobService.SLS_DEFAULT):
+        if loc:
+            paths.append(os.path.dirname(loc))
+    return paths
 
 def _auto_backends():
     """Return a list of available backends on this system."""
     
+    # systemd runs SysV scripts itself, so it is used on its own
+    if os.path.isdir('/run/systemd/system'):
+        return ['systemd']
+    
     # start with sysv
     load = ['sysv']
         
@@ -0,0 +1,350 @@
+# This file is part of jobservice.
+# Copyright 2010 Jacob Peddicord <jpeddicord@ubuntu.com>
+#
+# jobservice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jobservice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+from time import time
+from dbus import SystemBus, Interface, PROPERTIES_IFACE, Array, DBusException
+from JobService import DBUS_IFACE, JobException, cache
+from JobService.backends import ServiceBase
+from JobService.util import CallBatch, store_reply, wait_until
+from JobService.cache import FileIndex
+
+log = logging.getLogger('backends')
+
+SYSTEMD = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+MANAGER_IFACE = SYSTEMD + '.Manager'
+UNIT_IFACE = SYSTEMD + '.Unit'
+SERVICE_IFACE = SYSTEMD + '.Service'
+JOB_IFACE = SYSTEMD + '.Job'
+
+SUFFIX = '.service'     # only service units are listed, without the suffix
+UNITS_TTL = 1   # seconds the unit list is reused for
+JOB_TIMEOUT = 90    # seconds to wait for a start or stop to finish
+
+# unit file states that start a unit on boot
+ENABLED = ('enabled', 'enabled-runtime')
+
+class SystemdException(JobException):
+    _dbus_error_name = DBUS_IFACE + '.SystemdException'
+
+class UnitFileIndex(FileIndex):
+    """
+    The [Unit] and [Install] settings of unit files, keyed by path.
+    Settings are kept as lists, as most can be given more than once.
+    """
+    
+    def _parse(self, path):
+        props = {}
+        section = None
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[0] in '#;':
+                    continue
+                if line.startswith('['):
+                    section = line.strip('[]')
+                    continue
+                if section not in ('Unit', 'Install') or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                key = '{0}.{1}'.format(section, key.strip())
+                props.setdefault(key, []).append(value.strip())
+        return props
+
+class ServiceBackend(ServiceBase):
+    
+    def __init__(self, snapshot=None, bus=None):
+        """
+        Connect to systemd, on the system bus unless another bus connection
+        is given. Unit state lives in systemd, so snapshots are not used.
+        """
+        self.bus = bus or SystemBus()
+        self.manager = Interface(self.bus.get_object(SYSTEMD, SYSTEMD_PATH,
+                introspect=False), MANAGER_IFACE)
+        self.units = {}     # name: (description, active state, unit path)
+        self.units_time = 0
+        self.unitpaths = {} # unit path: name
+        self.files = {}     # name: (file path, unit file state)
+        self.headers = UnitFileIndex()
+        self.calls = 0
+        self.changed = None
+    
+    def get_all_services(self):
+        """
+        List loaded units and installed unit files, with one call each.
+        Template units can't be started by themselves, so only their
+        instances are listed.
+        """
+        self._list_units()
+        self._list_unit_files()
+        return sorted(self._services())
+    
+    def _services(self):
+        return set(self.units) | set(self.files)
+    
+    def _list_units(self):
+        units = {}
+        unitpaths = {}
+        for unit in self.manager.ListUnits():
+            unit_id, description, load, active = unit[:4]
+            if not unit_id.endswith(SUFFIX) or load == 'not-found':
+                continue
+            name = str(unit_id[:-len(SUFFIX)])
+            units[name] = (unicode(description), str(active), unit[6])
+            unitpaths[unit[6]] = name
+        self.calls += 1
+        self.units = units
+        self.unitpaths = unitpaths
+        self.units_time = time()
+    
+    def _list_unit_files(self):
+        files = {}
+        for path, state in self.manager.ListUnitFiles():
+            unit_id = os.path.basename(path)
+            if not unit_id.endswith(SUFFIX) or unit_id.endswith('@' + SUFFIX):
+                continue
+            files[str(unit_id[:-len(SUFFIX)])] = (str(path), str(state))
+        self.calls += 1
+        self.files = files
+    
+    def _get_units(self):
+        """Return the unit list, fetching it again every UNITS_TTL seconds."""
+        if time() - self.units_time >= UNITS_TTL:
+            self._list_units()
+        return self.units
+    
+    def _object(self, path):
+        return self.bus.get_object(SYSTEMD, path, introspect=False)
+    
+    def get_service(self, name):
+        info = self.get_service_info(name)
+        info.update(self.get_service_state(name))
+        return info
+    
+    def get_service_info(self, name):
+        info = {
+            'name': name,
+            'description': '',
+            'version': '',
+            'author': '',
+            'automatic': False,
+            'starton': Array(signature='s'),
+            'stopon': Array(signature='s'),
+            'file': '',
+        }
+        path, state = self.files.get(name, ('', ''))
+        info['file'] = path
+        info['automatic'] = state in ENABLED
+        if path:
+            props = self.headers.get(path, {})
+            info['description'] = props.get('Unit.Description', [''])[-1]
+            for key, text in (('Install.WantedBy', 'wanted by'),
+                              ('Install.RequiredBy', 'required by')):
+                for target in ' '.join(props.get(key, [])).split():
+                    info['starton'].append('{0} {1}'.format(text, target))
+        # systemd has already expanded any specifiers in loaded units
+        unit = self.units.get(name)
+        if unit and unit[0]:
+            info['description'] = unit[0]
+        return info
+    
+    def get_service_stamp(self, name, info):
+        """
+        Besides the unit file, info depends on its enablement state and
+        the description of the loaded unit.
+        """
+        unit = self.units.get(name)
+        return (cache.stamp([info['file']]), self.files.get(name),
+                unit and unit[0])
+    
+    def get_service_state(self, name):
+        unit = self._get_units().get(name)
+        state = _unit_state(unit)
+        if state['running']:
+            state['pid'] = int(self._object(unit[2]).Get(SERVICE_IFACE,
+                    'MainPID', dbus_interface=PROPERTIES_IFACE))
+            self.calls += 1
+        return state
+    
+    def get_services(self, names):
+        """
+        Gather information for several services from one unit listing,
+        fetching the main pids of running services all at once.
+        """
+        units = self._get_units()
+        infos = {}
+        pids = {}
+        batch = CallBatch(self.bus, SYSTEMD)
+        for name in names:
+            unit = units.get(name)
+            infos[name] = self.get_service_info(name)
+            infos[name].update(_unit_state(unit))
+            if infos[name]['running']:
+                batch.call(unit[2], PROPERTIES_IFACE, 'Get', 'ss',
+                        [SERVICE_IFACE, 'MainPID'], store_reply(pids, name))
+        try:
+            batch.wait()
+        except DBusException, e:
+            # units unloaded since the listing keep a pid of 0
+            log.debug('Unable to fetch all main pids: {0}'.format(e))
+        self.calls += batch.calls
+        for name, pid in pids.iteritems():
+            infos[name]['pid'] = int(pid)
+        return infos
+    
+    def get_stats(self):
+        return {'systemd_calls': self.calls}
+    
+    def get_service_depends(self, name, stop=False):
+        """
+        Order by the unit's After and Before settings, which systemd
+        reverses when stopping.
+        """
+        unit = self.units.get(name)
+        if unit:
+            path = unit[2]
+        else:
+            path = self.manager.LoadUnit(name + SUFFIX)
+            self.calls += 1
+        props = self._object(path).GetAll(UNIT_IFACE,
+                dbus_interface=PROPERTIES_IFACE)
+        self.calls += 1
+        names = [_service_name(n) for n in props.get('Names', [])]
+        before = [_service_name(n) for n in props.get('After', [])]
+        after = [_service_name(n) for n in props.get('Before', [])]
+        if stop:
+            before, after = after, before
+        return ([n for n in names if n != name], before, after)
+    
+    def start_service(self, name):
+        self._run_job(name, 'StartUnit')
+    
+    def stop_service(self, name):
+        self._run_job(name, 'StopUnit')
+    
+    def _run_job(self, name, method):
+        """Queue a start or stop job and wait for it to finish."""
+        job = getattr(self.manager, method)(name + SUFFIX, 'replace')
+        self.calls += 1
+        def finished():
+            self.calls += 1
+            try:
+                self._object(job).Get(JOB_IFACE, 'State',
+                        dbus_interface=PROPERTIES_IFACE)
+            except DBusException:
+                # finished jobs disappear from the bus
+                return True
+            return False
+        if not wait_until(finished, JOB_TIMEOUT):
+            raise SystemdException('Timed out waiting for {0}.'.format(name))
+        self._list_units()
+        unit = self.units.get(name)
+        if unit and unit[1] == 'failed':
+            raise SystemdException('{0} failed.'.format(name))
+    
+    def set_service_automatic(self, name, auto):
+        self.set_services_automatic([(name, auto)])
+    
+    def set_services_automatic(self, changes):
+        """
+        Enable and disable unit files with one call each, then have systemd
+        reload its configuration once.
+        """
+        enable = [name + SUFFIX for name, auto in changes if auto]
+        disable = [name + SUFFIX for name, auto in changes if not auto]
+        if enable:
+            self.manager.EnableUnitFiles(enable, False, True)
+            self.calls += 1
+        if disable:
+            self.manager.DisableUnitFiles(disable, False)
+            self.calls += 1
+        if enable or disable:
+            self.manager.Reload()
+            self.calls += 1
+            self._list_unit_files()
+    
+    def watch(self, callback):
+        """
+        Follow units being loaded and unloaded, changes to their state and
+        changes to unit files.
+        """
+        self.changed = callback
+        try:
+            self.manager.Subscribe()
+        except DBusException, e:
+            log.warn('Unable to subscribe to systemd signals: {0}'.format(e))
+            return
+        self.bus.add_signal_receiver(self._properties_changed,
+                'PropertiesChanged', PROPERTIES_IFACE, SYSTEMD,
+                path_keyword='path')
+        self.bus.add_signal_receiver(self._unit_new, 'UnitNew',
+                MANAGER_IFACE, SYSTEMD)
+        self.bus.add_signal_receiver(self._unit_removed, 'UnitRemoved',
+                MANAGER_IFACE, SYSTEMD)
+        self.bus.add_signal_receiver(self._unit_files_changed,
+                'UnitFilesChanged', MANAGER_IFACE, SYSTEMD)
+    
+    def _properties_changed(self, iface, changed, invalidated, path=None):
+        name = self.unitpaths.get(path)
+        if name and iface == UNIT_IFACE:
+            self.units_time = 0
+            self.changed([name])
+    
+    def _unit_new(self, unit_id, path):
+        if not unit_id.endswith(SUFFIX):
+            return
+        name = str(unit_id[:-len(SUFFIX)])
+        old = self._services()
+        # filled in by the next listing
+        self.units.setdefault(name, (u'', 'inactive', path))
+        self.unitpaths[path] = name
+        self.units_time = 0
+        self._publish(old, self._services())
+    
+    def _unit_removed(self, unit_id, path):
+        name = self.unitpaths.pop(path, None)
+        if not name:
+            return
+        old = self._services()
+        self.units.pop(name, None)
+        self._publish(old, self._services())
+        self.changed([name])
+    
+    def _unit_files_changed(self):
+        old = self._services()
+        files = self.files
+        self._list_unit_files()
+        self._publish(old, self._services())
+        names = [n for n in self.files if files.get(n) != self.files[n]]
+        if names:
+            self.changed(names)
+
+def _service_name(unit_id):
+    """Strip the .service suffix from a unit name."""
+    if unit_id.endswith(SUFFIX):
+        return str(unit_id[:-len(SUFFIX)])
+    return str(unit_id)
+
+def _unit_state(unit):
+    """Return the volatile properties for an entry of the unit list."""
+    if not unit or unit[1] in ('inactive', 'failed'):
+        return {'running': False, 'status': 'stopped', 'pid': 0}
+    if unit[1] in ('active', 'reloading'):
+        return {'running': True, 'status': 'running', 'pid': 0}
+    # activating or deactivating
+    return {'running': False, 'status': 'unknown', 'pid': 0}
@@ -15,24 +15,188 @@
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import logging
+from struct import unpack
+from time import time
+from signal import SIGKILL
 from stat import ST_MODE, S_ISLNK, S_IXUSR
 from subprocess import Popen, PIPE, check_call, CalledProcessError
 from dbus import Array
-from JobService import DBUS_IFACE, JobException
+from JobService import DBUS_IFACE, JobException, cache
 from JobService.backends import ServiceBase
+from JobService.util import watch_directory, parallel_map, wait_until
+from JobService.cache import FileIndex
 
+log = logging.getLogger('backends')
+
+PROC_TTL = 1    # seconds a process index is reused for
+STATUS_TIMEOUT = 5  # seconds an init script's status action may take
+STATUS_WORKERS = 8  # status actions run at once by get_services
+
+# common pidfile locations, tried for the job name and everything it provides
+PIDFILES = ('/var/run/{0}.pid', '/var/run/{0}/{0}.pid',
+            '/run/{0}.pid', '/run/{0}/{0}.pid')
+
+HEADER_BYTES = 8192  # LSB headers are expected within this many bytes
+
+RUNLEVELS = ('0', '1', '2', '3', '4', '5', '6', '7', 'S')
+RC_DIR = '/etc/rc{0}.d'
+
+# utmp records, as in <bits/utmp.h>
+UTMP = '/var/run/utmp'
+UTMP_SIZE = 384
+UTMP_RUN_LVL = 1
 
 class SysVException(JobException):
     _dbus_error_name = DBUS_IFACE + '.SysVException'
 
+class HeaderIndex(FileIndex):
+    """
+    LSB headers (### BEGIN INIT INFO blocks) of init scripts, keyed by path.
+    Values are kept as the strings found in the header; list fields such as
+    Provides or Required-Start can be split with get_list.
+    """
+    
+    def get(self, path):
+        """Return the header of the script at path, parsing it if needed."""
+        return FileIndex.get(self, path, {'file': path})
+    
+    def get_list(self, path, key):
+        """Return a whitespace-separated header field as a list."""
+        return self.get(path).get(key, '').split()
+    
+    def _parse(self, path):
+        """Read the LSB information at the start of a script."""
+        props = {'file': path}
+        try:
+            with open(path) as f:
+                data = f.read(HEADER_BYTES)
+                # unusually long preamble
+                if '### BEGIN INIT INFO' in data and \
+                        '### END INIT INFO' not in data:
+                    data += f.read()
+        except IOError:
+            return props
+        start = data.find('### BEGIN INIT INFO')
+        if start < 0:
+            return props
+        end = data.find('### END INIT INFO', start)
+        if end < 0:
+            end = len(data)
+        key = None
+        for line in data[start:end].splitlines()[1:]:
+            # continuation of the previous field (ie. Description)
+            if key and (line.startswith('#\t') or line.startswith('#  ')):
+                props[key] += ' ' + line[2:].strip()
+                continue
+            try:
+                key, value = line[2:].split(':', 1)
+            except ValueError:
+                key = None
+                continue
+            key = key.strip()
+            props[key] = value.strip()
+        return props
+
+class RunlevelIndex:
+    """
+    Links in the /etc/rc?.d directories, queryable by service and by
+    runlevel. A directory is only listed again when its mtime changes,
+    and only the services linked in it are updated.
+    """
+    
+    def __init__(self, dirs=None):
+        self.dirs = {}      # runlevel: (mtime, [(start, pri, name)])
+        self.services = {}  # name: {runlevel: (start, pri)}
+        for rlvl, (mtime, links) in (dirs or {}).iteritems():
+            self._update(rlvl, mtime, links)
+        self.refresh()
+    
+    def refresh(self):
+        """Re-list any rc directories that have changed."""
+        for rlvl in RUNLEVELS:
+            try:
+                mtime = os.stat(RC_DIR.format(rlvl)).st_mtime
+            except OSError:
+                mtime = None
+            if rlvl not in self.dirs or self.dirs[rlvl][0] != mtime:
+                self._update(rlvl, mtime, self._list(rlvl))
+    
+    def invalidate(self, rlvl):
+        """Force a runlevel to be listed again on the next refresh."""
+        if rlvl in self.dirs:
+            self.dirs[rlvl] = (None, self.dirs[rlvl][1])
+    
+    def get(self, name):
+        """Return a dictionary of runlevel: (bool start, int priority)."""
+        self.refresh()
+        return self.services.get(name, {})
+    
+    def sequence(self, rlvl):
+        """
+        Return the (bool start, int priority, name) links of a runlevel,
+        in the order they are run: stops first, then starts.
+        """
+        self.refresh()
+        return sorted(self.dirs[rlvl][1])
+    
+    def _list(self, rlvl):
+        links = []
+        try:
+            files = os.listdir(RC_DIR.format(rlvl))
+        except OSError:
+            return links
+        for link in files:
+            # links are named [SK]##name
+            if link[:1] not in ('S', 'K') or not link[1:3].isdigit():
+                continue
+            links.append((link[:1] == 'S', int(link[1:3]), link[3:]))
+        return links
+    
+    def _update(self, rlvl, mtime, links):
+        if rlvl in self.dirs:
+            for start, pri, name in self.dirs[rlvl][1]:
+                svc = self.services.get(name)
+                if svc and rlvl in svc:
+                    del svc[rlvl]
+                    if not svc:
+                        del self.services[name]
+        for start, pri, name in links:
+            self.services.setdefault(name, {})[rlvl] = (start, pri)
+        self.dirs[rlvl] = (mtime, links)
+
 class ServiceBackend(ServiceBase):
         
-    def __init__(self):
-        self.runlevels = self._get_runlevel_info()
+    def __init__(self, snapshot=None):
+        if snapshot:
+            self.rc = RunlevelIndex(snapshot['rc'])
+            self.headers = HeaderIndex(snapshot['headers'])
+        else:
+            self.rc = RunlevelIndex()
+            self.headers = HeaderIndex()
         self.current = self._get_current_runlevel()
+        self.procs = {}
+        self.procs_time = 0
+    
+    def get_snapshot(self):
+        return {'rc': self.rc.dirs, 'headers': self.headers.entries}
+    
+    def watch(self, callback):
+        self.monitors = []
+        def changed(path):
+            name = os.path.basename(path)
+            # rc links are named [SK]##name
+            if not path.startswith('/etc/init.d/'):
+                name = name[3:]
+            callback([name])
+        for d in ['/etc/init.d'] + [RC_DIR.format(r) for r in RUNLEVELS]:
+            monitor = watch_directory(d, changed)
+            if monitor:
+                self.monitors.append(monitor)
     
     def get_all_services(self):
         svclist = []
+        self.rc.refresh()
         for root, dirs, files in os.walk('/etc/init.d/'):
             for svc in files:
                 path = os.path.join(root, svc)
@@ -40,20 +204,28 @@ class ServiceBackend(ServiceBase):
                 # we only want regular, executable files
                 if not S_ISLNK(mode) and bool(mode & S_IXUSR):
                     # ignore files not linked in rc.d
-                    if svc in self.runlevels:
+                    if svc in self.rc.services:
                         svclist.append(svc)
             break
         return svclist
     
     def get_service(self, name):
+        info = self.get_service_info(name)
+        info.update(self.get_service_state(name))
+        return info
+    
+    def get_service_stamp(self, name, info):
+        """Start and stop runlevels come from the rc directories."""
+        paths = [info['file']] + [RC_DIR.format(r) for r in RUNLEVELS]
+        return cache.stamp(paths)
+    
+    def get_service_info(self, name):
         info = {
             'name': name,
             'description': '',
             'version': '',
             'author': '',
-            'running': False,
             'automatic': False,
-            'pid': 0,
             'starton': Array(signature='s'),
             'stopon': Array(signature='s'),
             'file': '',
@@ -64,19 +236,139 @@ class ServiceBackend(ServiceBase):
         if 'Short-Description' in props:
             info['description'] = props['Short-Description']
         # look through runlevel information
-        if name in self.runlevels:
-            for rlvl, start in self.runlevels[name].iteritems():
-                if start[0] == True:
-                    info['starton'].append(rlvl)
-                else:
-                    info['stopon'].append(rlvl)
-                if rlvl == self.current:
-                    info['automatic'] = start[0]
-        p = Popen(['/etc/init.d/' + name, 'status'], stdout=PIPE, stderr=PIPE)
-        p.communicate()   # eat stdout/stdin
-        info['running'] = (p.returncode == 0)
+        for rlvl, start in self.rc.get(name).iteritems():
+            if start[0] == True:
+                info['starton'].append(rlvl)
+            else:
+                info['stopon'].append(rlvl)
+            if rlvl == self.current:
+                info['automatic'] = start[0]
         return info
     
+    def get_services(self, names):
+        """
+        Gather information for several services, running the status
+        actions that are needed in parallel.
+        """
+        infos = {}
+        probe = []
+        for name in names:
+            infos[name] = self.get_service_info(name)
+            state = self._get_proc_state(name)
+            if state is None:
+                probe.append(name)
+            else:
+                infos[name].update(state)
+        states = parallel_map(self._get_status_state, probe, STATUS_WORKERS)
+        for name, state in zip(probe, states):
+            infos[name].update(state)
+        return infos
+    
+    def get_service_state(self, name):
+        """
+        Find out if a service is running from its pidfile or the process
+        list, only running the init script's status action if neither
+        gives an answer.
+        """
+        state = self._get_proc_state(name)
+        if state is None:
+            state = self._get_status_state(name)
+        return state
+    
+    def _get_status_state(self, name):
+        """
+        Run a service's status action, giving up after STATUS_TIMEOUT
+        seconds. Scripts that take too long are killed along with anything
+        they started, and the service's status is reported as unknown.
+        """
+        with open(os.devnull, 'w') as null:
+            p = Popen(['/etc/init.d/' + name, 'status'], stdout=null,
+                      stderr=null, preexec_fn=os.setsid)
+        if not wait_until(lambda: p.poll() is not None, STATUS_TIMEOUT):
+            log.warn('{0} status timed out'.format(name))
+            try:
+                os.killpg(p.pid, SIGKILL)
+            except OSError:
+                pass
+            p.wait()
+            return {'running': False, 'status': 'unknown', 'pid': 0}
+        running = (p.returncode == 0)
+        return {'running': running, 'pid': 0,
+                'status': 'running' if running else 'stopped'}
+    
+    def _get_proc_state(self, name):
+        """
+        Return the running state of a service without running anything,
+        or None if it can't be determined. A stale pidfile only counts as
+        stopped once no other pidfile or daemon has been found.
+        """
+        props = self._get_lsb_properties(name)
+        names = [name] + props.get('Provides', '').split()
+        # an explicit pidfile is the most reliable
+        pidfiles = [props[k] for k in ('X-Pidfile', 'pidfile') if k in props]
+        for n in names:
+            pidfiles += [loc.format(n) for loc in PIDFILES]
+        stale = False
+        for pidfile in pidfiles:
+            try:
+                with open(pidfile) as f:
+                    pid = int(f.readline().strip())
+            except (IOError, ValueError):
+                continue
+            proc = _proc_names(pid)
+            if not proc:
+                # the daemon may have written a newer one elsewhere
+                stale = True
+                continue
+            if _proc_matches(proc, names):
+                return {'running': True, 'status': 'running', 'pid': pid}
+            log.debug('Ignoring {0}, pid {1} is {2}'.format(pidfile, pid,
+                    proc[0]))
+        # otherwise look for a daemon of the same name
+        procs = self._get_proc_index()
+        for n in names:
+            if n in procs:
+                return {'running': True, 'status': 'running',
+                        'pid': procs[n][0]}
+        if stale:
+            return {'running': False, 'status': 'stopped', 'pid': 0}
+        return None
+    
+    def _get_proc_index(self):
+        """
+        Return a dictionary of process name: [pids] for all daemons, ie.
+        processes that have been reparented to init. Both the command name
+        and the executable name are indexed. The index is rebuilt at most
+        every PROC_TTL seconds, so bulk lookups share a single scan.
+        """
+        if time() - self.procs_time < PROC_TTL:
+            return self.procs
+        procs = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            proc = _proc_names(pid)
+            # gone already, a kernel thread, or not a daemon
+            if not proc or not proc[1] or proc[2] != '1':
+                continue
+            comm, exe, ppid = proc
+            for n in set((comm, exe)):
+                procs.setdefault(n, []).append(int(pid))
+        for pids in procs.itervalues():
+            pids.sort()
+        self.procs = procs
+        self.procs_time = time()
+        return procs
+    
+    def get_service_depends(self, name, stop=False):
+        path = '/etc/init.d/' + name
+        provides = self.headers.get_list(path, 'Provides')
+        if stop:
+            return (provides, [], self.headers.get_list(path, 'Required-Stop') +
+                    self.headers.get_list(path, 'Should-Stop'))
+        return (provides, self.headers.get_list(path, 'Required-Start') +
+                self.headers.get_list(path, 'Should-Start'), [])
+    
     def start_service(self, name):
         try:
             check_call(['/etc/init.d/' + name, 'start'])
@@ -94,73 +386,83 @@ class ServiceBackend(ServiceBase):
             raise SysVException('Stop failed: code {0}'.format(e.returncode))
     
     def set_service_automatic(self, name, auto):
-        if self.current not in self.runlevels[name]:
+        runlevels = self.rc.get(name)
+        if self.current not in runlevels:
             raise SysVException('Unsupported runlevel.')
-        self._remove_rc(name, self.current)
-        self._link_rc(name, self.current, auto)
-        self.runlevels[name][self.current] = (auto,
-                self.runlevels[name][self.current][1])
+        start, pri = runlevels[self.current]
+        self._remove_rc(name, self.current, start, pri)
+        self._link_rc(name, self.current, auto, pri)
+        self.rc.invalidate(self.current)
     
-    def _get_runlevel_info(self):
-        """Parse /etc/rc?.d and store symlink information.
-        
-        Returns a dictionary with service names as keys, and a dict of
-        runlevel: (bool start, int priority) pairs with found information.
-        """
-        svcs = {}
-        for runlevel in ('0', '1', '2', '3', '4', '5', '6', '7', 'S'):
-            for root, dirs, files in os.walk('/etc/rc{0}.d'.format(runlevel)):
-                for svc in files:
-                    path = os.path.join(root, svc)
-                    # exec only
-                    if not bool(os.lstat(path).st_mode & S_IXUSR):
-                        continue
-                    start = (svc[:1] == 'S')
-                    pri = int(svc[1:3])
-                    name = svc[3:]
-                    if not name in svcs:
-                        svcs[name] = {}
-                    svcs[name][runlevel] = (start, pri)
-                break
-        return svcs
-    
-    def _remove_rc(self, name, rlvl):
+    def _remove_rc(self, name, rlvl, start, pri):
         """Unlink a service from an rc#.d directory"""
-        pri = str(self.runlevels[name][rlvl][1])
-        mode = 'S' if self.runlevels[name][rlvl][0] else 'K'
-        os.unlink('/etc/rc{0}.d/{1}{2}{3}'.format(rlvl, mode, pri, name))
+        mode = 'S' if start else 'K'
+        os.unlink('/etc/rc{0}.d/{1}{2:02d}{3}'.format(rlvl, mode, pri, name))
     
-    def _link_rc(self, name, rlvl, start):
+    def _link_rc(self, name, rlvl, start, pri):
         """Re-link an init script to the proper rc#.d location"""
-        pri = str(self.runlevels[name][rlvl][1])
         mode = 'S' if start else 'K'
         os.symlink('/etc/init.d/' + name,
-                   '/etc/rc{0}.d/{1}{2}{3}'.format(rlvl, mode, pri, name))
+                   '/etc/rc{0}.d/{1}{2:02d}{3}'.format(rlvl, mode, pri, name))
     
     def _get_current_runlevel(self):
+        """
+        Read the current runlevel from the last runlevel record in utmp,
+        only asking /sbin/runlevel if there isn't one.
+        """
+        current = None
+        try:
+            with open(UTMP, 'rb') as f:
+                while True:
+                    record = f.read(UTMP_SIZE)
+                    if len(record) < UTMP_SIZE:
+                        break
+                    ut_type, ut_pid = unpack('=hxxi', record[:8])
+                    # the runlevel is stored in the low byte of ut_pid
+                    if ut_type == UTMP_RUN_LVL:
+                        current = chr(ut_pid & 0xff)
+        except IOError:
+            pass
+        if current:
+            return current
         out = Popen(['/sbin/runlevel'], stdout=PIPE).communicate()[0]
         return out.split()[1]
     
     def _get_lsb_properties(self, name):
         """
-        Scan a service's init.d entry for LSB information about it.
-        Returns a dictionary of the entries provided.
+        Return a dictionary of the LSB information in a service's init.d
+        entry, from the header index.
         """
-        props = {'file': '/etc/init.d/' + name}
-        try:
-            entry = open(props['file'])
-        except IOError: return props
-        parsing = False
-        for line in entry:
-            if not parsing:
-                if '### BEGIN INIT INFO' in line:
-                    parsing = True
-                continue
-            if '### END INIT INFO' in line:
-                break
-            try:
-                key, value = line[2:].split(': ')
-            except: continue
-            props[key] = value.strip()
-        entry.close()
-        return props
+        return self.headers.get('/etc/init.d/' + name)
+
+def _proc_names(pid):
+    """
+    Return (command name, executable name, parent pid) of a process, or
+    None if it has gone. The executable is '' for kernel threads.
+    """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    try:
+        exe = os.readlink('/proc/{0}/exe'.format(pid))
+        exe = os.path.basename(exe.replace(' (deleted)', ''))
+    except OSError:
+        exe = ''
+    comm = stat[stat.find('(')+1:stat.rfind(')')]
+    ppid = stat[stat.rfind(')')+2:].split()[1]
+    return (comm, exe, ppid)
+
+def _proc_matches(proc, names):
+    """
+    Check that a process from _proc_names runs one of names, allowing for
+    daemons named like "sshd" and for command names cut at 15 characters.
+    """
+    comm, exe, ppid = proc
+    for n in names:
+        if comm.startswith(n) or n[:15] == comm:
+            return True
+        if exe and exe.startswith(n):
+            return True
+    return False
@@ -14,93 +14,361 @@
 # You should have received a copy of the GNU General Public License
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 from os import rename
-from dbus import SystemBus, Interface, PROPERTIES_IFACE, Array
+from os.path import basename
+from glib import idle_add
+from dbus import SystemBus, Interface, PROPERTIES_IFACE, Array, DBusException
 from JobService.backends import ServiceBase
+from JobService.backends.upstart_conf import ConfIndex
+from JobService.util import watch_directory, CallBatch, store_reply
 
+log = logging.getLogger('backends')
+
+INIT_DIR = '/etc/init'  # where job configuration files live
 
 class ServiceBackend(ServiceBase):
     
-    def __init__(self):
+    def __init__(self, snapshot=None, bus=None, initdir=INIT_DIR):
         """
-        Connect to Upstart's dbus service.
+        Connect to Upstart's dbus service, on the system bus unless another
+        bus connection is given. Job state lives in Upstart, so snapshots
+        are not used.
         """
-        self.jobpaths = {}
-        self.instpaths = {}
-        self.bus = SystemBus()
+        self.initdir = initdir
+        self.jobpaths = {}      # job name: path
+        self.jobnames = {}      # path: job name
+        self.jobprops = {}      # path: job properties
+        self.instpaths = {}     # job path: [instance paths]
+        self.instnames = {}     # job path: {instance name: path}
+        self.instprops = {}     # instance path: properties, loaded on demand
+        self.confs = ConfIndex()
+        self.calls = 0
+        self.monitor = None
+        self.bus = bus or SystemBus()
         self.upstart = Interface(
             self.bus.get_object('com.ubuntu.Upstart', '/com/ubuntu/Upstart'),
             'com.ubuntu.Upstart0_6'
         )
     
     def get_all_services(self):
+        """
+        Find all jobs and their instances. Calls are sent out in two rounds
+        (job properties and instance lists, then instance properties)
+        without waiting for each reply in turn.
+        """
+        batch = CallBatch(self.bus, 'com.ubuntu.Upstart')
+        jobprops = {}
+        instances = {}
+        paths = self.upstart.GetAllJobs()
+        batch.calls += 1
+        for path in paths:
+            batch.call(path, PROPERTIES_IFACE, 'GetAll', 's',
+                    ['com.ubuntu.Upstart0_6.Job'], store_reply(jobprops, path))
+            batch.call(path, 'com.ubuntu.Upstart0_6.Job', 'GetAllInstances',
+                    '', [], store_reply(instances, path))
+        batch.wait()
+        # get the instance(s) and their states
+        instprops = {}
+        for path in paths:
+            for inst_path in instances[path]:
+                batch.call(inst_path, PROPERTIES_IFACE, 'GetAll', 's',
+                        ['com.ubuntu.Upstart0_6.Instance'],
+                        store_reply(instprops, inst_path))
+        batch.wait()
+        self.calls += batch.calls
+        log.debug('Enumerated Upstart jobs with {0} calls'.format(batch.calls))
+        # rebuild the index
+        self.jobpaths = {}
+        self.jobnames = {}
+        self.jobprops = {}
+        self.instpaths = {}
+        self.instnames = {}
+        self.instprops = {}
         svclist = []
-        for path in self.upstart.GetAllJobs():
-            job_obj = self.bus.get_object('com.ubuntu.Upstart', path)
-            job_name = job_obj.Get('com.ubuntu.Upstart0_6.Job', 'name',
-                                    dbus_interface=PROPERTIES_IFACE)
-            job = Interface(job_obj, 'com.ubuntu.Upstart0_6.Job')
-            self.jobpaths[job_name] = path
-            # get the instance(s) and their states
-            instances = job.GetAllInstances()
-            self.instpaths[path] = []
-            if instances:
-                for inst_path in instances:
-                    self.instpaths[path].append(inst_path)
-                    inst_obj = self.bus.get_object('com.ubuntu.Upstart',
-                            inst_path)
-                    inst_name = inst_obj.Get('com.ubuntu.Upstart0_6.Instance',
-                            'name', dbus_interface=PROPERTIES_IFACE)
-                    if inst_name:
-                        svclist.append(job_name + '/' + inst_name)
-                    # if there is no instance name, there's probably only one
-                    else:
-                        svclist.append(job_name)
+        for path in paths:
+            job_name = self._add_job(path, jobprops[path])
+            for inst_path in instances[path]:
+                inst_name = self._add_instance(path, inst_path,
+                        instprops[inst_path])
+                if inst_name:
+                    svclist.append(job_name + '/' + inst_name)
+                # if there is no instance name, there's probably only one
+                else:
+                    svclist.append(job_name)
             # no running instances
-            else:
+            if not instances[path]:
                 svclist.append(job_name)
         return svclist
     
+    def _add_job(self, path, props):
+        """Add a job to the index, returning its name."""
+        job_name = props['name']
+        self.jobpaths[job_name] = path
+        self.jobnames[path] = job_name
+        self.jobprops[path] = props
+        self.instpaths.setdefault(path, [])
+        self.instnames.setdefault(path, {})
+        return job_name
+    
+    def _remove_job(self, path):
+        """Remove a job and its instances from the index."""
+        for inst_path in self.instpaths.pop(path, []):
+            self.instprops.pop(inst_path, None)
+        self.instnames.pop(path, None)
+        self.jobprops.pop(path, None)
+        job_name = self.jobnames.pop(path, None)
+        if self.jobpaths.get(job_name) == path:
+            del self.jobpaths[job_name]
+        return job_name
+    
+    def _add_instance(self, job_path, inst_path, props):
+        """Add an instance to the index, returning its name."""
+        if inst_path not in self.instpaths[job_path]:
+            self.instpaths[job_path].append(inst_path)
+        self.instnames[job_path][props['name']] = inst_path
+        self.instprops[inst_path] = props
+        return props['name']
+    
+    def _remove_instance(self, job_path, inst_path):
+        """Remove an instance from the index."""
+        if inst_path in self.instpaths.get(job_path, []):
+            self.instpaths[job_path].remove(inst_path)
+        for inst_name, path in self.instnames.get(job_path, {}).items():
+            if path == inst_path:
+                del self.instnames[job_path][inst_name]
+        self.instprops.pop(inst_path, None)
+    
+    def _job_services(self, job_path):
+        """Return the set of service names a job is listed as."""
+        job_name = self.jobnames.get(job_path)
+        if not job_name:
+            return set()
+        names = set()
+        for inst_name in self.instnames[job_path]:
+            if inst_name:
+                names.add(job_name + '/' + inst_name)
+            else:
+                names.add(job_name)
+        return names or set([job_name])
+    
+    def _refresh_instances(self, job_name):
+        """
+        Re-read the instances of a single job, ie. after starting it. This
+        runs from the main loop, with the index updated as replies arrive.
+        """
+        path = self.jobpaths.get(job_name)
+        if not path:
+            return False
+        # the state of the current instances has probably changed
+        for inst_path in self.instpaths[path]:
+            self.instprops.pop(inst_path, None)
+        def found(inst_paths):
+            if path not in self.instpaths:
+                return
+            old = self._job_services(path)
+            for inst_path in list(self.instpaths[path]):
+                if inst_path not in inst_paths:
+                    self._remove_instance(path, inst_path)
+            self._publish(old, self._job_services(path))
+            for inst_path in inst_paths:
+                if inst_path not in self.instpaths[path]:
+                    self._instance_added(inst_path, path)
+        self._call_async(path, 'com.ubuntu.Upstart0_6.Job', 'GetAllInstances',
+                '', [], found)
+        return False
+    
+    def _object(self, path):
+        """Return a proxy for an Upstart object without introspecting it."""
+        return self.bus.get_object('com.ubuntu.Upstart', path,
+                introspect=False)
+    
+    def _inst_props(self, inst_path):
+        """Return the properties of an instance, fetching them if needed."""
+        if inst_path not in self.instprops:
+            self.calls += 1
+            self.instprops[inst_path] = self._object(inst_path).GetAll(
+                    'com.ubuntu.Upstart0_6.Instance',
+                    dbus_interface=PROPERTIES_IFACE)
+        return self.instprops[inst_path]
+    
+    def _call_async(self, path, iface, method, signature, args, handler):
+        """Call an Upstart method from the main loop without blocking it."""
+        self.calls += 1
+        def error(e):
+            log.debug('{0} on {1} failed: {2}'.format(method, path, e))
+        self.bus.call_async('com.ubuntu.Upstart', path, iface, method,
+                signature, args, handler, error)
+    
+    def get_stats(self):
+        return {'upstart_calls': self.calls}
+    
+    def watch(self, callback):
+        """
+        Follow jobs and instances coming and going, instance state changes
+        and edits to job files, keeping the index up to date.
+        """
+        self.changed = callback
+        self.bus.add_signal_receiver(self._job_added, 'JobAdded',
+                'com.ubuntu.Upstart0_6', 'com.ubuntu.Upstart')
+        self.bus.add_signal_receiver(self._job_removed, 'JobRemoved',
+                'com.ubuntu.Upstart0_6', 'com.ubuntu.Upstart')
+        self.bus.add_signal_receiver(self._state_changed, 'StateChanged',
+                'com.ubuntu.Upstart0_6.Instance', 'com.ubuntu.Upstart',
+                path_keyword='path')
+        self.bus.add_signal_receiver(self._instance_added, 'InstanceAdded',
+                'com.ubuntu.Upstart0_6.Job', 'com.ubuntu.Upstart',
+                path_keyword='path')
+        self.bus.add_signal_receiver(self._instance_removed, 'InstanceRemoved',
+                'com.ubuntu.Upstart0_6.Job', 'com.ubuntu.Upstart',
+                path_keyword='path')
+        self.monitor = watch_directory(self.initdir, self._file_changed)
+    
+    def _file_changed(self, path):
+        if path.endswith('.conf'):
+            self._refresh_job(basename(path)[:-5])
+    
+    def _refresh_job(self, job_name):
+        """Reload a job's properties, ie. after its file was edited."""
+        if job_name not in self.jobpaths:
+            self.changed([job_name])
+            return
+        path = self.jobpaths[job_name]
+        def loaded(props):
+            self.jobprops[path] = props
+            self.changed([job_name])
+        self._call_async(path, PROPERTIES_IFACE, 'GetAll', 's',
+                ['com.ubuntu.Upstart0_6.Job'], loaded)
+    
+    def _job_added(self, path):
+        def loaded(props):
+            old = self._job_services(path)
+            self.changed([self._add_job(path, props)])
+            self._publish(old, self._job_services(path))
+        self._call_async(path, PROPERTIES_IFACE, 'GetAll', 's',
+                ['com.ubuntu.Upstart0_6.Job'], loaded)
+    
+    def _job_removed(self, path):
+        self._publish(self._job_services(path), set())
+        job_name = self._remove_job(path)
+        if job_name:
+            self.changed([job_name])
+    
+    def _state_changed(self, state, path=None):
+        # the pid has probably changed too, so fetch it again when needed
+        self.instprops.pop(path, None)
+        job_name = self.jobnames.get(path[:path.rfind('/')])
+        if job_name:
+            self.changed([job_name])
+    
+    def _instance_added(self, inst_path, path=None):
+        if path not in self.jobnames:
+            return
+        def loaded(props):
+            if path in self.instpaths:
+                old = self._job_services(path)
+                self._add_instance(path, inst_path, props)
+                self.changed([self.jobnames[path]])
+                self._publish(old, self._job_services(path))
+        self._call_async(inst_path, PROPERTIES_IFACE, 'GetAll', 's',
+                ['com.ubuntu.Upstart0_6.Instance'], loaded)
+    
+    def _instance_removed(self, inst_path, path=None):
+        old = self._job_services(path)
+        self._remove_instance(path, inst_path)
+        self._publish(old, self._job_services(path))
+        job_name = self.jobnames.get(path)
+        if job_name:
+            self.changed([job_name])
+    
     def get_service(self, name):
+        info = self.get_service_info(name)
+        info.update(self.get_service_state(name))
+        return info
+    
+    def get_services(self, names):
+        """
+        Gather information for several services, first fetching the
+        properties of all instances not known yet in one round of calls.
+        """
+        batch = CallBatch(self.bus, 'com.ubuntu.Upstart')
+        wanted = set()
+        for name in names:
+            inst_path = self._inst_path(*self._split_job(name))
+            if inst_path and inst_path not in self.instprops:
+                wanted.add(inst_path)
+        for inst_path in wanted:
+            batch.call(inst_path, PROPERTIES_IFACE, 'GetAll', 's',
+                    ['com.ubuntu.Upstart0_6.Instance'],
+                    store_reply(self.instprops, inst_path))
+        try:
+            batch.wait()
+        except DBusException, e:
+            # any instances missed are fetched one by one below
+            log.debug('Unable to fetch all instances: {0}'.format(e))
+        self.calls += batch.calls
+        return ServiceBase.get_services(self, names)
+    
+    def get_service_info(self, name):
         # some defaults for values we might not find
         info = {
-            'running': False,
             'automatic': False,
-            'pid': 0,
             'starton': Array(signature='s'),
             'stopon': Array(signature='s'),
             'description': '',
         }
         job_name, inst_name = self._split_job(name)
         # job-level properties
-        job_obj = self.bus.get_object('com.ubuntu.Upstart',
-                self.jobpaths[job_name])
-        props = job_obj.GetAll('com.ubuntu.Upstart0_6.Job',
-                dbus_interface=PROPERTIES_IFACE)
+        props = dict(self.jobprops[self.jobpaths[job_name]])
         # starton/stopon
-        info['file'] = '/etc/init/{0}.conf'.format(job_name)
-        try:
-            with open(info['file']) as conf:
-                starton = self._parse_conf(conf, 'start on')
-                stopon = self._parse_conf(conf, 'stop on')
-                info['starton'] += self._extract_events(starton)
-                info['stopon'] += self._extract_events(stopon)
-                # automatic if starton isn't commented out
-                info['automatic'] = (starton[0] != '#')
-        except:
+        info['file'] = '{0}/{1}.conf'.format(self.initdir, job_name)
+        conf = self.confs.get(info['file'])
+        if not conf:
             return info
+        if conf.start:
+            info['starton'] += conf.start.describe()
+        if conf.stop:
+            info['stopon'] += conf.stop.describe()
+        # automatic if starton isn't commented out
+        info['automatic'] = conf.automatic()
+        # differentiate instances in descriptions
+        if inst_name and 'description' in props:
+            props['description'] += " ({0})".format(inst_name)
+        info.update(props)
+        return info
+    
+    def get_service_state(self, name):
+        info = {'running': False, 'status': 'stopped', 'pid': 0}
+        job_name, inst_name = self._split_job(name)
         # running state: check the instance(s)
         inst_obj, inst_props = self._get_inst(job_name, inst_name)
         if inst_obj:
             info['running'] = (inst_props['state'] == 'running')
+            if info['running']:
+                info['status'] = 'running'
             if inst_props['processes']:
                 info['pid'] = inst_props['processes'][0][1]
-        # differentiate instances in descriptions
-        if inst_name and 'description' in props:
-            props['description'] += " ({0})".format(inst_name)
-        info.update(props)
         return info
     
+    def get_service_depends(self, name, stop=False):
+        """
+        Order by the jobs in starting/started (or stopping/stopped) events
+        of the job's start on (or stop on) condition.
+        """
+        job_name, inst_name = self._split_job(name)
+        before = []
+        after = []
+        for event in self.get_service_info(name)['stopon' if stop else 'starton']:
+            words = event.split()
+            if len(words) != 2:
+                continue
+            # "started x": x goes first, "starting x": x waits for us
+            if words[0] in ('started', 'stopped'):
+                before.append(words[1])
+            elif words[0] in ('starting', 'stopping'):
+                after.append(words[1])
+        return ([job_name], before, after)
+    
     def start_service(self, name):
         """
         If a job is given, try to start its instance first if it has one.
@@ -110,29 +378,26 @@ class ServiceBackend(ServiceBase):
         job_name, inst_name = self._split_job(name)
         # no instances, start the job
         if not self.instpaths[self.jobpaths[job_name]]:
-            job_obj = self.bus.get_object('com.ubuntu.Upstart',
-                    self.jobpaths[job_name])
+            job_obj = self._object(self.jobpaths[job_name])
             job = Interface(job_obj, 'com.ubuntu.Upstart0_6.Job')
             job.Start([], True)
         # one or more instances available
         else:
             inst_obj, inst_props = self._get_inst(job_name, inst_name)
             inst_obj.Start(True, dbus_interface='com.ubuntu.Upstart0_6.Instance')
-        # reload
-        self.get_all_services()
+        idle_add(self._refresh_instances, job_name)
         
     def stop_service(self, name):
         """Find the appropritate job instance and stop it."""
         job_name, inst_name = self._split_job(name)
         inst_obj, inst_props = self._get_inst(job_name, inst_name)
         inst_obj.Stop(True, dbus_interface='com.ubuntu.Upstart0_6.Instance')
-        # reload
-        self.get_all_services()
+        idle_add(self._refresh_instances, job_name)
     
     def set_service_automatic(self, name, auto):
         job_name, inst_name = self._split_job(name)
-        with open('/etc/init/{0}.conf'.format(job_name)) as conf:
-            self._set_automatic(conf, auto)
+        self._set_automatic('{0}/{1}.conf'.format(self.initdir, job_name),
+                auto)
     
     def _split_job(self, name):
         """Return (job_name, inst_name) from name."""
@@ -145,81 +410,31 @@ class ServiceBackend(ServiceBase):
     
     def _get_inst(self, job_name, inst_name):
         """Return (inst_obj, inst_props) matching job_name & inst_name."""
-        paths = self.instpaths[self.jobpaths[job_name]]
-        if not paths:
+        inst_path = self._inst_path(job_name, inst_name)
+        if not inst_path:
             return (None, None)
-        for inst_path in paths:
-            inst_obj = self.bus.get_object('com.ubuntu.Upstart', inst_path)
-            inst_props = inst_obj.GetAll('com.ubuntu.Upstart0_6.Instance',
-                    dbus_interface=PROPERTIES_IFACE)
-            if inst_props['name'] == inst_name:
-                break
-        return (inst_obj, inst_props)
+        return (self._object(inst_path), self._inst_props(inst_path))
+    
+    def _inst_path(self, job_name, inst_name):
+        """Return the path of the instance matching job_name & inst_name."""
+        job_path = self.jobpaths[job_name]
+        paths = self.instpaths[job_path]
+        if not paths:
+            return None
+        # unnamed instances have an empty name; fall back on the last one
+        return self.instnames[job_path].get(inst_name or '', paths[-1])
         
-    def _set_automatic(self, conf, automatic=True):
-        """Comment/uncomment a job conf file's start on line. Closes conf."""
-        newname = '{0}.new'.format(conf.name)
+    def _set_automatic(self, path, automatic=True):
+        """Comment/uncomment only the start on stanza of a job file."""
+        conf = self.confs.get(path)
+        if not conf:
+            raise IOError('Could not read {0}'.format(path))
+        data = conf.set_automatic(automatic)
+        if data is None:
+            return
+        newname = '{0}.new'.format(path)
         with open(newname, 'w') as new:
-            for line in conf:
-                # if we find a start on line
-                pos = line.find('start on')
-                if pos >= 0 and pos <= 2:
-                    starton = '\n' + self._parse_conf(conf, 'start on')
-                    # enabling
-                    if automatic:
-                        starton = starton.rstrip().replace('\n#', '\n')
-                    # disabling
-                    else:
-                        starton = starton.rstrip().replace('\n', '\n#')
-                    new.write(starton.lstrip() + '\n')
-                    continue
-                new.write(line)
-        conf.close()
-        rename(conf.name, '{0}~'.format(conf.name))
-        rename(newname, conf.name)
-        
-    def _parse_conf(self, conf, find):
-        """
-        Parse file 'conf' for text 'find' and return the value.
-        Useful for grabbing the full contents of a start/stop on line.
-        """
-        conf.seek(0)
-        reading = False
-        data = ""
-        paren = 0
-        for line in conf:
-            # could be at pos 1 or 2 if line is commented out
-            pos = line.find(find)
-            if pos >= 0 and pos <= 2:
-                reading = True
-            if reading:
-                data += line
-                paren += line.count('(') - line.count(')')
-                if not paren:
-                    break
-        return data
-    
-    def _extract_events(self, data):
-        """
-        Grab events present in a text string (ie, a start/stop on line).
-        An event could be a runlevel or a starting/stopping string.
-        """
-        events = []
-        keywords = ('starting', 'stopping', 'started', 'stopped', 'runlevel')
-        words = [d.strip(' ()') for d in data.split()]
-        i = 0
-        for w in words:
-            if w in keywords:
-                if w == 'runlevel':
-                    try:
-                        levels = words[i+1].strip('[]')
-                    except:
-                        levels = ''
-                    if levels and levels[0] == '!':
-                        events.append('not runlevels {0}'.format(' '.join(levels[1:])))
-                    else:
-                        events.append('runlevels {0}'.format(' '.join(levels)))
-                else:
-                    events.append('{0} {1}'.format(w, words[i+1]))
-            i += 1
-        return events
+            new.write(data)
+        rename(path, '{0}~'.format(path))
+        rename(newname, path)
+        self.confs.invalidate(path)
@@ -1,2 +1,116 @@
-# temporary!
-from .upstart_0_6 import *
+# This file is part of jobservice.
+# Copyright 2010 Jacob Peddicord <jpeddicord@ubuntu.com>
+#
+# jobservice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jobservice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from os.path import basename
+from dbus import Array
+from JobService import cache
+from JobService.backends import upstart_0_6
+from JobService.backends.upstart_0_6 import INIT_DIR
+from JobService.backends.upstart_conf import ConfFile
+
+class ServiceBackend(upstart_0_6.ServiceBackend):
+    """
+    Upstart 1.x speaks the same D-Bus interface as 0.6, so jobs are found
+    the same way. Jobs are disabled with a "manual" stanza in
+    /etc/init/<job>.override instead of editing the packaged job file.
+    """
+    
+    def __init__(self, snapshot=None, bus=None, initdir=INIT_DIR):
+        upstart_0_6.ServiceBackend.__init__(self, snapshot, bus, initdir)
+        self.overrides = {}     # job name: parsed override file, or None
+    
+    def get_service_info(self, name):
+        info = upstart_0_6.ServiceBackend.get_service_info(self, name)
+        job_name, inst_name = self._split_job(name)
+        conf = self.confs.get(info['file'])
+        if conf and conf.manual:
+            info['automatic'] = False
+        override = self._get_override(job_name)
+        if not override:
+            return info
+        # the override is read after the job, so its start on replaces the
+        # job's own and undoes a manual stanza there
+        if override.start and not override.start.commented:
+            info['starton'] = Array(override.start.describe(), signature='s')
+            info['automatic'] = True
+        if override.stop and not override.stop.commented:
+            info['stopon'] = Array(override.stop.describe(), signature='s')
+        if override.manual:
+            info['automatic'] = False
+        return info
+    
+    def get_service_stamp(self, name, info):
+        job_name, inst_name = self._split_job(name)
+        return cache.stamp([info['file'], self._override_path(job_name)])
+    
+    def set_service_automatic(self, name, auto):
+        job_name, inst_name = self._split_job(name)
+        # jobs disabled by older versions had their start on commented out
+        conf = self.confs.get('{0}/{1}.conf'.format(self.initdir, job_name))
+        if auto and conf and conf.start and conf.start.commented:
+            upstart_0_6.ServiceBackend.set_service_automatic(self, name, auto)
+        path = self._override_path(job_name)
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except IOError:
+            lines = []
+        keep = [l for l in lines if l.split('#', 1)[0].strip() != 'manual']
+        add = None
+        if not auto:
+            add = 'manual\n'
+        elif conf and conf.manual and conf.automatic():
+            # only a start on in the override undoes the job's own manual
+            if not ConfFile(path, ''.join(keep)).automatic():
+                add = 'start on {0}\n'.format(conf.start.text)
+        if add:
+            if keep and not keep[-1].endswith('\n'):
+                keep[-1] += '\n'
+            keep.append(add)
+        if keep == lines:
+            return
+        if keep:
+            newname = '{0}.new'.format(path)
+            with open(newname, 'w') as new:
+                new.writelines(keep)
+            os.rename(newname, path)
+        else:
+            os.remove(path)
+        self.confs.invalidate(path)
+        self.overrides.pop(job_name, None)
+    
+    def _file_changed(self, path):
+        if path.endswith('.override'):
+            job_name = basename(path)[:-9]
+            self.overrides.pop(job_name, None)
+            self.changed([job_name])
+            return
+        upstart_0_6.ServiceBackend._file_changed(self, path)
+    
+    def _get_override(self, job_name):
+        """
+        Return a job's parsed override file, or None. Without a directory
+        monitor to tell us about changes, the file is checked every time.
+        """
+        if self.monitor and job_name in self.overrides:
+            return self.overrides[job_name]
+        override = self.confs.get(self._override_path(job_name))
+        self.overrides[job_name] = override
+        return override
+    
+    def _override_path(self, job_name):
+        return '{0}/{1}.override'.format(self.initdir, job_name)
@@ -0,0 +1,247 @@
+# This file is part of jobservice.
+# Copyright 2010 Jacob Peddicord <jpeddicord@ubuntu.com>
+#
+# jobservice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jobservice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import logging
+from JobService.cache import FileIndex
+
+log = logging.getLogger('backends')
+
+# a start on/stop on stanza, possibly commented out
+STANZA_RE = re.compile(r'[ \t]*(#[ \t]*)?(start|stop)[ \t]+on(?=[\s(]|$)')
+
+# a manual stanza, as used in override files
+MANUAL_RE = re.compile(r'^[ \t]*manual[ \t]*(#.*)?$', re.M)
+
+# events that name another job, as in "started networking"
+JOB_EVENTS = ('starting', 'started', 'stopping', 'stopped')
+
+class Event:
+    """An event in a start/stop condition, with its arguments."""
+    
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+    
+    def __repr__(self):
+        return 'Event({0!r}, {1!r})'.format(self.name, self.args)
+    
+    def runlevels(self):
+        """
+        Return (negated, levels) for a runlevel event, as in
+        "runlevel [!026]" or "runlevel RUNLEVEL=[2345]".
+        """
+        if not self.args:
+            return (False, '')
+        value = self.args[0]
+        negated = False
+        if '=' in value:
+            key, value = value.split('=', 1)
+            negated = key.endswith('!')
+        value = value.strip('[]')
+        if value.startswith('!'):
+            negated = not negated
+            value = value[1:]
+        return (negated, value)
+    
+    def describe(self):
+        """
+        Return a description of the event for the starton/stopon
+        properties, or None for events not shown there.
+        """
+        if self.name == 'runlevel':
+            negated, levels = self.runlevels()
+            text = 'runlevels {0}'.format(' '.join(levels))
+            if negated:
+                text = 'not ' + text
+            return text
+        if self.name in JOB_EVENTS and self.args:
+            return '{0} {1}'.format(self.name, self.args[0])
+        return None
+
+class Operator:
+    """Two conditions joined by "and" or "or"."""
+    
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+    
+    def __repr__(self):
+        return 'Operator({0!r}, {1!r}, {2!r})'.format(self.op, self.left,
+                self.right)
+
+class Stanza:
+    """
+    A start on or stop on stanza: its parsed condition, and the byte
+    offsets of the lines it spans in the file.
+    """
+    
+    def __init__(self, keyword, comment, begin, end, text):
+        self.keyword = keyword
+        self.commented = bool(comment)
+        # how likely this is the real stanza: active ones first, then ones
+        # we disabled ourselves ("#start on"), then other comments
+        if not comment:
+            self.rank = 0
+        elif comment == '#':
+            self.rank = 1
+        else:
+            self.rank = 2
+        self.begin = begin
+        self.end = end
+        self.text = text
+        self.expr = parse_condition(text)
+    
+    def events(self):
+        """Return all events in the condition, left to right."""
+        events = []
+        stack = [self.expr]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Operator):
+                stack.append(node.right)
+                stack.append(node.left)
+            elif node is not None:
+                events.append(node)
+        return events
+    
+    def describe(self):
+        """Return descriptions of the events shown in properties."""
+        return [d for d in (e.describe() for e in self.events()) if d]
+
+class ConfFile:
+    """A parsed job configuration file."""
+    
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.start = None
+        self.stop = None
+        self.manual = bool(MANUAL_RE.search(data))
+        for stanza in find_stanzas(data):
+            attr = stanza.keyword
+            current = getattr(self, attr)
+            if not current or stanza.rank < current.rank:
+                setattr(self, attr, stanza)
+    
+    def automatic(self):
+        return bool(self.start) and not self.start.commented
+    
+    def set_automatic(self, automatic):
+        """
+        Return the file contents with the start on stanza commented or
+        uncommented, or None if there is nothing to change.
+        """
+        start = self.start
+        if not start or start.commented != automatic:
+            return None
+        lines = self.data[start.begin:start.end].splitlines(True)
+        if automatic:
+            lines = [re.sub(r'^([ \t]*)#', r'\1', l) for l in lines]
+        else:
+            lines = ['#' + l for l in lines]
+        return self.data[:start.begin] + ''.join(lines) + \
+                self.data[start.end:]
+
+class ConfIndex(FileIndex):
+    """Parsed job configuration files, keyed by path."""
+    
+    def _parse(self, path):
+        with open(path) as f:
+            return ConfFile(path, f.read())
+
+def find_stanzas(data):
+    """Return the start on and stop on stanzas in a job file's contents."""
+    stanzas = []
+    lines = data.splitlines(True)
+    offsets = []
+    pos = 0
+    for line in lines:
+        offsets.append(pos)
+        pos += len(line)
+    offsets.append(pos)
+    i = 0
+    while i < len(lines):
+        match = STANZA_RE.match(lines[i])
+        if not match:
+            i += 1
+            continue
+        comment = match.group(1)
+        text = _strip_comment(lines[i][match.end():])
+        depth = text.count('(') - text.count(')')
+        j = i + 1
+        # conditions continue over lines while parentheses are open
+        while j < len(lines) and (depth > 0 or text.endswith('\\')):
+            line = lines[j]
+            if comment:
+                stripped = line.lstrip(' \t')
+                if not stripped.startswith('#'):
+                    break
+                line = stripped[1:]
+            line = _strip_comment(line)
+            text = text.rstrip('\\') + ' ' + line
+            depth += line.count('(') - line.count(')')
+            j += 1
+        stanzas.append(Stanza(match.group(2), comment, offsets[i],
+                offsets[j], text))
+        i = j
+    return stanzas
+
+def parse_condition(text):
+    """
+    Parse a start/stop condition into a tree of Operator and Event nodes.
+    Like Upstart, "and" and "or" have equal precedence and group from the
+    left; use parentheses otherwise. Returns None for an empty condition.
+    """
+    tokens = re.findall(r'[()]|[^\s()]+', text)
+    tokens.reverse()
+    expr = _parse_expr(tokens)
+    if tokens:
+        log.debug('Ignoring trailing tokens in condition: {0}'.format(text))
+    return expr
+
+def _parse_expr(tokens):
+    left = _parse_term(tokens)
+    while tokens and tokens[-1] in ('and', 'or'):
+        op = tokens.pop()
+        right = _parse_term(tokens)
+        if left is None:
+            left = right
+        elif right is not None:
+            left = Operator(op, left, right)
+    return left
+
+def _parse_term(tokens):
+    if not tokens:
+        return None
+    if tokens[-1] == '(':
+        tokens.pop()
+        expr = _parse_expr(tokens)
+        if tokens and tokens[-1] == ')':
+            tokens.pop()
+        return expr
+    if tokens[-1] in (')', 'and', 'or'):
+        return None
+    name = tokens.pop()
+    args = []
+    while tokens and tokens[-1] not in ('(', ')', 'and', 'or'):
+        args.append(tokens.pop())
+    return Event(name, args)
+
+def _strip_comment(line):
+    """Drop a trailing comment and surrounding whitespace from a line."""
+    return line.split('#', 1)[0].strip()
@@ -0,0 +1,112 @@
+# This file is part of jobservice.
+# Copyright 2010 Jacob Peddicord <jpeddicord@ubuntu.com>
+#
+# jobservice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jobservice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import logging
+from cPickle import load, dump, HIGHEST_PROTOCOL
+import JobService
+
+log = logging.getLogger('jobservice')
+
+VERSION = 4     # bump whenever the format of cached data changes
+
+def stamp(paths):
+    """
+    Return a cache key made of the inode and mtime of every path.
+    Missing paths are included so that their creation is noticed.
+    """
+    key = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            key.append((path, st.st_ino, st.st_mtime))
+        except OSError:
+            key.append((path, None, None))
+    return key
+
+class FileIndex:
+    """
+    Parsed files, keyed by path. A file is only read and parsed again when
+    its inode, size or mtime changes. Subclasses override _parse(path) to
+    return the parsed form of a file; it may raise IOError if the file
+    can't be read. By default, a file's contents are kept as they are.
+    """
+    
+    def __init__(self, entries=None):
+        self.entries = entries or {}    # path: (inode, size, mtime, parsed)
+    
+    def get(self, path, default=None):
+        """Return the parsed file at path, or default if it can't be read."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.entries.pop(path, None)
+            return default
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        entry = self.entries.get(path)
+        if entry and entry[:3] == key:
+            return entry[3]
+        try:
+            parsed = self._parse(path)
+        except IOError:
+            return default
+        self.entries[path] = key + (parsed,)
+        return parsed
+    
+    def invalidate(self, path):
+        """Read a file again on the next get, ie. after writing it."""
+        self.entries.pop(path, None)
+    
+    def _parse(self, path):
+        with open(path) as f:
+            return f.read()
+
+def load_snapshot(name, key):
+    """
+    Return the data stored in snapshot 'name' if it was saved with the
+    same key and cache version, otherwise None.
+    """
+    if not JobService.CACHE_DIR:
+        return None
+    filename = os.path.join(JobService.CACHE_DIR, name)
+    try:
+        with open(filename, 'rb') as f:
+            # only trust files written by ourselves
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return None
+            version, oldkey, data = load(f)
+    except Exception:
+        return None
+    if version != VERSION or oldkey != key:
+        log.debug('Snapshot {0} is out of date'.format(name))
+        return None
+    log.debug('Using snapshot {0}'.format(name))
+    return data
+
+def save_snapshot(name, key, data):
+    """Atomically store data in snapshot 'name', valid for key."""
+    if not JobService.CACHE_DIR:
+        return
+    filename = os.path.join(JobService.CACHE_DIR, name)
+    try:
+        if not os.path.isdir(JobService.CACHE_DIR):
+            os.makedirs(JobService.CACHE_DIR, 0755)
+        with open(filename + '.new', 'wb') as f:
+            dump((VERSION, key, data), f, HIGHEST_PROTOCOL)
+        os.rename(filename + '.new', filename)
+    except (IOError, OSError), e:
+        log.warn('Unable to save snapshot {0}: {1}'.format(name, e))
@@ -15,116 +15,170 @@
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from dbus import PROPERTIES_IFACE
-from dbus.service import BusName, Object as DBusObject, method as DBusMethod
-from JobService import DBUS_JOB_IFACE, JobException
+from time import time
+from JobService import DBUS_PATH
+from JobService.util import dbus_safe_name
 
 log = logging.getLogger('jobservice')
 
-class SingleJobService(DBusObject):
-    """Export a single job as its own object on our bus."""
+JOB_IDLE = 120  # seconds before an unused job's state is dropped
+STATE_TTL = 5   # seconds that running state is trusted for
+JOB_WORKERS = 4 # threads running job operations such as Start and Stop
+
+# properties that all jobs are expected to have
+PROPERTIES = ['name', 'description', 'version', 'author', 'running',
+              'status', 'automatic', 'pid', 'starton', 'stopon', 'file',
+              'backend', 'settings']
+
+# properties that change on their own, rather than with the job's file
+VOLATILE = ['running', 'status', 'pid']
+
+class SingleJobService:
+    """
+    State for a single job, created by the root object on first access.
+    
+    The root object exports every job path through one fallback object, so
+    there is no per-job D-Bus object; this only holds what is worth caching.
     
-    def __init__(self, conn=None, object_path=None,
-                 bus_name=None, name=None, root=None):
-        DBusObject.__init__(self, conn, object_path, bus_name)
+    Properties are cached in two parts: the job's info is kept until the
+    backend's stamp of the files it comes from changes, while its running
+    state expires after STATE_TTL seconds. Each is only loaded when one of
+    its properties is asked for.
+    """
+    
+    def __init__(self, name, root):
         self.name = name
         self.root = root
-        self.path = self.__dbus_object_path__
-        self._props = {}
-    
-    @DBusMethod(PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
-    def GetAll(self, interface):
-        self.root.idle.ping()
-        if interface != DBUS_JOB_IFACE:
-            raise JobException('Interface not supported.')
-        self._load_properties()
-        return self._props
-            
-    @DBusMethod(PROPERTIES_IFACE, in_signature='ss', out_signature='v')
-    def Get(self, interface, prop):
-        self.root.idle.ping()
-        if interface != DBUS_JOB_IFACE:
-            raise JobException('Interface not supported.')
-        self._load_properties()
-        return self._props[prop]
-    
-    @DBusMethod(DBUS_JOB_IFACE, in_signature='', out_signature='',
-                sender_keyword='sender', connection_keyword='conn')
-    def Start(self, sender=None, conn=None):
-        """Start a job by name. Does not enable/disable the job."""
-        self.root.idle.ping()
-        log.debug('Start called on {0}'.format(self.name))
-        self.root.policy.check(sender, conn)
+        self.path = '/'.join((DBUS_PATH, dbus_safe_name(name)))
+        self.lastused = time()
+        self._info = {}
+        self._stamp = None
+        self._state = {}
+        self._expires = 0
+        self.generation = 0     # bumped whenever the caches are dropped
+    
+    def ping(self):
+        self.lastused = time()
+    
+    def idle(self, now):
+        """Return True if this job has not been used recently."""
+        return now - self.lastused > JOB_IDLE
+    
+    def get_properties(self):
+        props = {}
+        props.update(self._load_info())
+        props.update(self._load_state())
+        return props
+    
+    def get_property(self, prop):
+        if prop in VOLATILE:
+            return self._load_state()[prop]
+        return self._load_info()[prop]
+    
+    def reload(self):
+        """
+        Reload the job's properties after an outside change.
+        Returns (changed, invalidated) as for PropertiesChanged.
+        """
+        info, state = self._info, self._state
+        self.invalidate()
+        if not info and not state:
+            return ({}, PROPERTIES)
+        # only reload what was loaded before
+        old = {}
+        new = {}
+        if info:
+            old.update(info)
+            new.update(self._load_info())
+        if state:
+            old.update(state)
+            new.update(self._load_state())
+        changed = {}
+        for key, value in new.iteritems():
+            if key not in old or old[key] != value:
+                changed[key] = value
+        invalidated = []
+        if not info:
+            invalidated += [p for p in PROPERTIES if p not in VOLATILE]
+        if not state:
+            invalidated += VOLATILE
+        return (changed, invalidated)
+    
+    def invalidate(self, info=True, state=True):
+        self.generation += 1
+        if info:
+            self._info = {}
+        if state:
+            self._state = {}
+    
+    def get_cached(self):
+        """
+        Return all properties if none of them need loading, or None. Used
+        with store to load the properties of many jobs at once.
+        """
+        stats = self.root.cachestats
+        if not self._info or not self._state or time() >= self._expires:
+            return None
+        if self._stamp != self.root.proxy.get_service_stamp(self.name,
+                                                            self._info):
+            return None
+        stats['info_hits'] += 1
+        stats['state_hits'] += 1
+        props = {}
+        props.update(self._info)
+        props.update(self._state)
+        return props
+    
+    def store(self, props, stamp, generation):
+        """
+        Cache properties loaded elsewhere along with the stamp of their
+        info, unless the caches were dropped after the load began.
+        """
+        stats = self.root.cachestats
+        stats['info_misses'] += 1
+        stats['state_misses'] += 1
+        if generation != self.generation:
+            return
+        self._info = dict((k, v) for k, v in props.iteritems()
+                          if k not in VOLATILE)
+        self._stamp = stamp
+        self._state = dict((k, v) for k, v in props.iteritems()
+                           if k in VOLATILE)
+        self._expires = time() + STATE_TTL
+    
+    def start(self):
         self.root.proxy.start_service(self.name)
-        self._props = {}
-    
-    @DBusMethod(DBUS_JOB_IFACE, in_signature='', out_signature='',
-                sender_keyword='sender', connection_keyword='conn')
-    def Stop(self, sender=None, conn=None):
-        """Stop a job by name. Does not enable/disable the job."""
-        self.root.idle.ping()
-        log.debug('Stop called on {0}'.format(self.name))
-        self.root.policy.check(sender, conn)
+    
+    def stop(self):
         self.root.proxy.stop_service(self.name)
-        self._props = {}
-    
-    @DBusMethod(DBUS_JOB_IFACE, in_signature='b', out_signature='',
-                sender_keyword='sender', connection_keyword='conn')
-    def SetAutomatic(self, auto, sender=None, conn=None):
-        """Make a job automatic or manual. Does not change state."""
-        self.root.idle.ping()
-        log.debug('SetAutomatic ({1}) called on {0}'.format(self.name, auto))
-        self.root.policy.check(sender, conn)
+    
+    def set_automatic(self, auto):
         self.root.proxy.set_service_automatic(self.name, auto)
-        self._props = {}
     
-    @DBusMethod(DBUS_JOB_IFACE, in_signature='s',
-                out_signature='a(ssssa(ss)a{ss})',
-                sender_keyword='sender', connection_keyword='conn')
-    def GetSettings(self, lang, sender=None, conn=None):
-        """
-        Return a job's available settings and constraints.
-        
-        Takes a single argument (locale) used to determine what language the
-        descriptions should be sent in. If unknown, use an empty string.
-        
-        Returns list of struct settings (
-            string name
-            string type
-            string description
-            string current-value
-            list of struct values (
-                string name
-                string description
-            )
-            dict constraints {
-                key: string type
-                value: string value
-            }
-        )
-        """
-        self.root.idle.ping()
-        log.debug('GetSettings ({1}) called on {0}'.format(self.name, lang))
+    def get_settings(self, lang):
         return self.root.proxy.get_service_settings(self.name, lang)
     
-    @DBusMethod(DBUS_JOB_IFACE, in_signature='a{ss}', out_signature='',
-                sender_keyword='sender', connection_keyword='conn')
-    def SetSettings(self, settings, sender=None, conn=None):
-        """Change a job's settings after validating."""
-        self.root.idle.ping()
-        log.debug('SetSettings called on {0}'.format(self.name))
-        self.root.policy.check(sender, conn)
+    def set_settings(self, settings):
         self.root.proxy.set_service_settings(self.name, settings)
-        self._props = {}
-    
-    @DBusMethod(DBUS_JOB_IFACE, in_signature='ss', out_signature='b',
-                sender_keyword='sender', connection_keyword='conn')
-    def ValidateSetting(self, setting, value, sender=None, conn=None):
-        """Verify a setting's value is valid."""
-        self.root.idle.ping()
-        log.debug('ValidateSetting ({1}) called on {0}'.format(self.name, setting))
-    
-    def _load_properties(self):
-        if not self._props:
-            self._props = self.root.proxy.get_service(self.name)
-        
+    
+    def _load_info(self):
+        stats = self.root.cachestats
+        proxy = self.root.proxy
+        stamp = self._info and proxy.get_service_stamp(self.name, self._info)
+        if self._info and self._stamp == stamp:
+            stats['info_hits'] += 1
+            return self._info
+        stats['info_misses'] += 1
+        self._info = proxy.get_service_info(self.name)
+        self._stamp = proxy.get_service_stamp(self.name, self._info)
+        return self._info
+    
+    def _load_state(self):
+        stats = self.root.cachestats
+        if self._state and time() < self._expires:
+            stats['state_hits'] += 1
+            return self._state
+        stats['state_misses'] += 1
+        self._state = self.root.proxy.get_service_state(self.name)
+        self._expires = time() + STATE_TTL
+        return self._state
@@ -15,10 +15,14 @@
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from time import time
 from dbus import SystemBus, DBusException, Interface, UInt64
 
 log = logging.getLogger('policy')
 
+AUTH_TIMEOUT = 500  # seconds the user has to authenticate
+POLICY_TTL = 60 # seconds an authorization is reused for; 0 disables caching
+
 class DeniedByPolicy(DBusException):
     _dbus_error_name = 'com.ubuntu.JobService.DeniedByPolicy'
 
@@ -28,31 +32,109 @@ class Policy:
         self.enforce = enforce
         self.bus = SystemBus()
         self.dbus_iface = None
+        self.granted = {}   # (sender, action): time of authorization
+        self.senders = {}   # sender: NameOwnerChanged match
+        self.pending = {}   # (sender, action): [(callback, errback)]
         self.pk = Interface(self.bus.get_object('org.freedesktop.PolicyKit1',
                 '/org/freedesktop/PolicyKit1/Authority'),
                 'org.freedesktop.PolicyKit1.Authority')
+        # authorizations can be revoked or expire
+        self.pk.connect_to_signal('Changed', self.forget)
         
         if not enforce:
             log.warn('Not enforcing PolicyKit privileges!')
     
-    def check(self, sender, conn, priv='com.ubuntu.jobservice.manage'):
+    def check(self, sender, conn, callback, errback,
+              priv='com.ubuntu.jobservice.manage'):
         """
-        Check or ask for authentication for job management.
+        Check or ask for authentication for job management, calling
+        callback() once authorized or errback(exception) if not.
+        
+        PolicyKit is asked without blocking, so other clients are served
+        while a user authenticates. Checks of the same sender and action
+        made in the meantime wait on the same PolicyKit call.
         """
-        if not self.enforce: return
+        if not self.enforce:
+            callback()
+            return
+        key = (sender, priv)
+        granted = self.granted.get(key)
+        if granted and time() - granted < POLICY_TTL:
+            callback()
+            return
+        if key in self.pending:
+            self.pending[key].append((callback, errback))
+            return
+        self.pending[key] = [(callback, errback)]
         log.debug('Asking for PolicyKit authorization')
+        def failed(e):
+            self._finish(key, e)
+        def answered(result):
+            auth, challenge, details = result
+            if not auth:
+                log.info('Authorization failed')
+                self._finish(key,
+                        DeniedByPolicy('Not authorized to manage jobs.'))
+                return
+            log.debug('Authorization passed')
+            if POLICY_TTL > 0:
+                self._remember(sender, priv)
+            self._finish(key)
+        def got_pid(pid):
+            # ask PolicyKit; the call can also fail before it is sent
+            try:
+                self.pk.CheckAuthorization(
+                        ('unix-process', {'pid': pid, 'start-time': UInt64(0)}),
+                        priv, {'': ''}, 1, '', timeout=AUTH_TIMEOUT,
+                        reply_handler=answered, error_handler=failed)
+            except Exception, e:
+                failed(e)
         # get the PID of the sender
-        if not self.dbus_iface:
-            self.dbus_iface = Interface(conn.get_object('org.freedesktop.DBus',
-                    '/org/freedesktop/DBus/Bus'), 'org.freedesktop.DBus')
-        pid = self.dbus_iface.GetConnectionUnixProcessID(sender)
-        # ask PolicyKit
-        auth, challenge, details = self.pk.CheckAuthorization(
-                ('unix-process', {'pid': pid, 'start-time': UInt64(0)}),
-                priv, {'': ''}, 1, '', timeout=500)
-        if not auth:
-            log.info('Authorization failed')
-            raise DeniedByPolicy('Not authorized to manage jobs.')
-        log.debug('Authorization passed')
+        try:
+            if not self.dbus_iface:
+                self.dbus_iface = Interface(conn.get_object(
+                        'org.freedesktop.DBus', '/org/freedesktop/DBus/Bus'),
+                        'org.freedesktop.DBus')
+            self.dbus_iface.GetConnectionUnixProcessID(sender,
+                    reply_handler=got_pid, error_handler=failed)
+        except Exception, e:
+            failed(e)
+    
+    def _finish(self, key, error=None):
+        """Pass the outcome of a check on to everyone waiting on it."""
+        for callback, errback in self.pending.pop(key):
+            try:
+                if error:
+                    errback(error)
+                else:
+                    callback()
+            except Exception, e:
+                log.error('Unable to finish authorized call: {0}'.format(e))
+    
+    def forget(self, sender=None):
+        """Forget authorizations of a sender, or of everyone."""
+        for key in self.granted.keys():
+            if sender is None or key[0] == sender:
+                del self.granted[key]
+        for name in self.senders.keys():
+            if sender is None or name == sender:
+                self.senders.pop(name).remove()
+    
+    def _remember(self, sender, priv):
+        """
+        Reuse an authorization until it expires or the sender goes away.
+        Unique names are never reused, so a new client can't inherit one.
+        """
+        self.granted[(sender, priv)] = time()
+        if sender not in self.senders:
+            self.senders[sender] = self.bus.add_signal_receiver(
+                    self._name_owner_changed, 'NameOwnerChanged',
+                    'org.freedesktop.DBus', 'org.freedesktop.DBus',
+                    '/org/freedesktop/DBus', arg0=sender)
+    
+    def _name_owner_changed(self, name, old, new):
+        if not new:
+            log.debug('Forgetting authorizations of {0}'.format(name))
+            self.forget(name)
         
             
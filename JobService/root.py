@@ -16,36 +16,160 @@
 
 import sys
 import logging
-from dbus.service import Object as DBusObject, method as DBusMethod
-from JobService import DBUS_PATH, DBUS_IFACE
+from time import time
+from glib import timeout_add_seconds, idle_add
+from dbus import PROPERTIES_IFACE
+from dbus.service import BusName, FallbackObject, method as DBusMethod, \
+        signal as DBusSignal
+from JobService import DBUS_PATH, DBUS_IFACE, DBUS_JOB_IFACE, JobException
 from JobService.backends import ServiceProxy
-from JobService.job import SingleJobService
+from JobService.job import SingleJobService, JOB_IDLE, JOB_WORKERS, \
+        PROPERTIES
 from JobService.policy import Policy
-from JobService.util import dbus_safe_name
+from JobService.util import dbus_safe_name, dbus_unsafe_name, WorkerPool
 
 log = logging.getLogger('jobservice')
 
-class RootJobService(DBusObject):
+class RootJobService(FallbackObject):
+    """
+    Export the root object along with every job path beneath it.
+    
+    Job paths are not registered individually; messages for them fall back
+    to this object, which decodes the path into a job name and looks up (or
+    creates) that job's state on demand.
+    """
 
     def __init__(self, conn=None, object_path=None, bus_name=None, idle=None, enforce=True):
         """
-        Fire up this service as well as all of the paths for individual jobs.
+        Fire up this service and discover the available jobs.
         """
-        DBusObject.__init__(self, conn, object_path, bus_name)
+        if isinstance(conn, BusName):
+            bus_name = conn
+            conn = bus_name.get_bus()
+        FallbackObject.__init__(self, conn, object_path)
         
+        self.bus_name = bus_name
         self.idle = idle
         self.policy = Policy(enforce)
         self.proxy = ServiceProxy()
-        self.jobs = []
-        
-        allsvcs = self.proxy.get_all_services()
-        for job in allsvcs:
-            self.jobs.append(SingleJobService(conn,
-                '/'.join((DBUS_PATH, dbus_safe_name(job))),
-                name=job, root=self
-            ))
+        self.pool = WorkerPool(JOB_WORKERS)
+        self.jobs = {}
+        self.cachestats = {'info_hits': 0, 'info_misses': 0,
+                           'state_hits': 0, 'state_misses': 0}
+        self.jobnames = self.proxy.get_all_services()
+        self.changed = set()
+        self.proxy.watch(self._jobs_changed)
+        self.proxy.watch_services(self._services_changed)
+        timeout_add_seconds(JOB_IDLE, self._evict_jobs)
         
         log.info('Ready')
+    
+    def get_job(self, path):
+        """Return the job state for a path relative to the root object."""
+        try:
+            name = dbus_unsafe_name(path.lstrip('/'))
+        except ValueError:
+            name = None
+        if not name or name not in self.proxy.bkmap:
+            raise JobException('No such job.')
+        return self._get_job(name)
+    
+    def _get_job(self, name):
+        if name not in self.jobs:
+            self.jobs[name] = SingleJobService(name, self)
+        job = self.jobs[name]
+        job.ping()
+        return job
+    
+    def _run(self, key, func, args, reply, error, changed=None):
+        """
+        Run an operation in the worker pool, replying once it's done.
+        Operations with the same key (ie. job name) never overlap; an
+        operation on several jobs takes a list of their names.
+        
+        changed(), if given, is called from the main loop once the
+        operation has finished, successfully or not, to drop cached
+        properties it may have changed. Caches are only ever touched from
+        the main loop.
+        """
+        def done(result):
+            self.idle.ping()
+            if changed:
+                changed()
+            if result is None:
+                reply()
+            else:
+                reply(result)
+        def failed(e):
+            if changed:
+                changed()
+            error(e)
+        self.pool.submit(key, func, args, done, failed)
+    
+    def _run_authorized(self, sender, conn, key, func, args, reply, error,
+                        changed=None):
+        """Run an operation once the sender is authorized to make changes."""
+        def authorized():
+            self._run(key, func, args, reply, error, changed)
+        self.policy.check(sender, conn, authorized, error)
+    
+    def _invalidate(self, names, info=True, state=True):
+        """Drop the cached properties of jobs, from the main loop."""
+        for name in names:
+            job = self.jobs.get(name)
+            if job:
+                job.invalidate(info, state)
+    
+    def _evict_jobs(self):
+        """Drop the state of jobs that haven't been used in a while."""
+        now = time()
+        for name in self.jobs.keys():
+            if self.jobs[name].idle(now):
+                del self.jobs[name]
+        return True
+    
+    def _services_changed(self, added, removed):
+        """Publish jobs that appeared or disappeared, from the main loop."""
+        idle_add(self._publish_jobs, added, removed)
+    
+    def _publish_jobs(self, added, removed):
+        for name in removed:
+            if name in self.jobnames:
+                self.jobnames.remove(name)
+                self.jobs.pop(name, None)
+                path = '/'.join((DBUS_PATH, dbus_safe_name(name)))
+                self.JobRemoved(name, path)
+        for name in added:
+            if name not in self.jobnames:
+                self.jobnames.append(name)
+                path = '/'.join((DBUS_PATH, dbus_safe_name(name)))
+                self.JobAdded(name, path)
+        return False
+    
+    def _jobs_changed(self, names):
+        """Queue jobs changed behind our back for a single update."""
+        if not self.changed:
+            idle_add(self._emit_changes)
+        self.changed.update(names)
+    
+    def _emit_changes(self):
+        """Refresh changed jobs and tell clients what is different."""
+        changed = self.changed
+        self.changed = set()
+        for name in self.jobnames:
+            # instances are covered by their job's name
+            if name not in changed and name.split('/')[0] not in changed:
+                continue
+            props, invalidated = {}, PROPERTIES
+            if name in self.jobs:
+                try:
+                    props, invalidated = self.jobs[name].reload()
+                except Exception, e:
+                    log.debug('Unable to reload {0}: {1}'.format(name, e))
+            if props or invalidated:
+                self.PropertiesChanged(DBUS_JOB_IFACE, props, invalidated,
+                        path='/' + dbus_safe_name(name))
+        return False
         
     @DBusMethod(DBUS_IFACE, in_signature='', out_signature='a(so)',
                 sender_keyword='sender', connection_keyword='conn')
@@ -61,6 +185,289 @@ class RootJobService(DBusObject):
         self.idle.ping()
         log.debug('GetAllJobs called')
         svclist = []
-        for job in self.jobs:
-            svclist.append((job.name, job.path))
+        for name in self.jobnames:
+            svclist.append((name, '/'.join((DBUS_PATH, dbus_safe_name(name)))))
         return svclist
+    
+    @DBusMethod(DBUS_IFACE, in_signature='as', out_signature='a(soa{sv})',
+                sender_keyword='sender', connection_keyword='conn',
+                async_callbacks=('reply', 'error'))
+    def GetAllJobsWithProperties(self, props, sender=None, conn=None,
+                                 reply=None, error=None):
+        """
+        Returns all jobs known by the backend(s) along with their properties,
+        saving a GetAll call for every job. Jobs are served from their
+        caches, and the rest are loaded together in a worker thread. A job
+        whose properties can't be loaded is listed with none.
+        
+        Takes a list of property names to include. If empty, all properties
+        are returned.
+        
+        Returns array of struct (
+            string name
+            object path
+            dict properties {
+                key: string name
+                value: variant value
+            }
+        )
+        """
+        self.idle.ping()
+        log.debug('GetAllJobsWithProperties called')
+        names = list(self.jobnames)
+        infos = {}
+        missing = {}    # name: generation of its job's caches
+        for name in names:
+            job = self._get_job(name)
+            infos[name] = job.get_cached()
+            if infos[name] is None:
+                missing[name] = job.generation
+        def loaded(results):
+            for name, (info, stamp) in results.iteritems():
+                infos[name] = info
+                if name in self.jobs:
+                    self.jobs[name].store(info, stamp, missing[name])
+            svclist = []
+            for name in names:
+                info = infos[name] or {}
+                if props:
+                    info = dict((k, v) for k, v in info.iteritems()
+                                if k in props)
+                path = '/'.join((DBUS_PATH, dbus_safe_name(name)))
+                svclist.append((name, path, info))
+            reply(svclist)
+        if not missing:
+            loaded({})
+            return
+        # one bulk load at a time, however many clients are polling
+        self.pool.submit('GetAllJobsWithProperties', self._load_jobs,
+                (missing.keys(),), loaded, error)
+    
+    def _load_jobs(self, names):
+        """
+        Load the properties of several jobs at once, from a worker.
+        Returns a dictionary of name: (properties, stamp of their info).
+        """
+        results = {}
+        for name, info in self.proxy.get_services(names).iteritems():
+            try:
+                stamp = self.proxy.get_service_stamp(name, info)
+            except Exception, e:
+                log.debug('Unable to stamp {0}: {1}'.format(name, e))
+                continue
+            results[name] = (info, stamp)
+        return results
+    
+    @DBusMethod(DBUS_IFACE, in_signature='as', out_signature='a(sbsd)',
+                sender_keyword='sender', connection_keyword='conn',
+                async_callbacks=('reply', 'error'))
+    def StartMany(self, names, sender=None, conn=None, reply=None, error=None):
+        """
+        Start several jobs at once. Jobs are started in order of their
+        dependencies, with independent jobs started in parallel.
+        
+        Returns array of struct (
+            string name
+            boolean success
+            string error message
+            double seconds taken
+        )
+        """
+        self.idle.ping()
+        log.debug('StartMany called on {0}'.format(', '.join(names)))
+        self._check_names(names)
+        self._run_authorized(sender, conn, list(names),
+                self.proxy.start_services, (names,), reply, error,
+                lambda: self._invalidate(names, info=False))
+    
+    @DBusMethod(DBUS_IFACE, in_signature='as', out_signature='a(sbsd)',
+                sender_keyword='sender', connection_keyword='conn',
+                async_callbacks=('reply', 'error'))
+    def StopMany(self, names, sender=None, conn=None, reply=None, error=None):
+        """
+        Stop several jobs at once, in reverse order of their dependencies.
+        Returns the same as StartMany.
+        """
+        self.idle.ping()
+        log.debug('StopMany called on {0}'.format(', '.join(names)))
+        self._check_names(names)
+        self._run_authorized(sender, conn, list(names),
+                self.proxy.stop_services, (names,), reply, error,
+                lambda: self._invalidate(names, info=False))
+    
+    @DBusMethod(DBUS_IFACE, in_signature='a(ssa{ss})', out_signature='',
+                sender_keyword='sender', connection_keyword='conn',
+                async_callbacks=('reply', 'error'))
+    def ApplyChanges(self, changes, sender=None, conn=None, reply=None,
+                     error=None):
+        """
+        Make several changes to jobs with a single authorization. Every
+        change is validated before any is made, and if one fails, the
+        changes already made are undone.
+        
+        Takes array of struct (
+            string job name
+            string operation: start, stop, automatic or settings
+            dict arguments {
+                key: string name (automatic: "automatic"; settings: setting)
+                value: string value (automatic: "true" or "false")
+            }
+        )
+        """
+        self.idle.ping()
+        log.debug('ApplyChanges called')
+        steps = self.proxy.plan_changes(changes)
+        names = [name for name, op, arg in steps]
+        self._run_authorized(sender, conn, names, self.proxy.apply_changes,
+                (steps,), reply, error, lambda: self._invalidate(names))
+    
+    def _check_names(self, names):
+        for name in names:
+            if name not in self.proxy.bkmap:
+                raise JobException('No such job: {0}'.format(name))
+    
+    @DBusMethod(DBUS_IFACE, in_signature='', out_signature='a{st}')
+    def GetCacheStats(self):
+        """
+        Returns hit and miss counters of the job property caches, for
+        tuning how long properties are cached for.
+        
+        Returns dict {
+            key: string counter name
+            value: uint64 count
+        }
+        """
+        self.idle.ping()
+        return self.cachestats
+    
+    @DBusMethod(DBUS_IFACE, in_signature='', out_signature='a{sv}')
+    def GetBackendStats(self):
+        """
+        Returns discovery timings and other counters kept by the backends,
+        such as the number of calls made to Upstart.
+        
+        Returns dict {
+            key: string counter name
+            value: variant value
+        }
+        """
+        self.idle.ping()
+        return self.proxy.get_stats()
+    
+    @DBusMethod(PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}',
+                rel_path_keyword='path')
+    def GetAll(self, interface, path=None):
+        self.idle.ping()
+        if interface != DBUS_JOB_IFACE:
+            raise JobException('Interface not supported.')
+        return self.get_job(path).get_properties()
+            
+    @DBusMethod(PROPERTIES_IFACE, in_signature='ss', out_signature='v',
+                rel_path_keyword='path')
+    def Get(self, interface, prop, path=None):
+        self.idle.ping()
+        if interface != DBUS_JOB_IFACE:
+            raise JobException('Interface not supported.')
+        return self.get_job(path).get_property(prop)
+    
+    @DBusSignal(DBUS_IFACE, signature='so')
+    def JobAdded(self, name, path):
+        """Emitted when a new job (or job instance) appears."""
+        pass
+    
+    @DBusSignal(DBUS_IFACE, signature='so')
+    def JobRemoved(self, name, path):
+        """Emitted when a job (or job instance) goes away."""
+        pass
+    
+    @DBusSignal(PROPERTIES_IFACE, signature='sa{sv}as',
+                rel_path_keyword='path')
+    def PropertiesChanged(self, interface, changed, invalidated, path=None):
+        """Emitted on a job's path when it changes outside of our control."""
+        pass
+    
+    @DBusMethod(DBUS_JOB_IFACE, in_signature='', out_signature='',
+                sender_keyword='sender', connection_keyword='conn',
+                rel_path_keyword='path', async_callbacks=('reply', 'error'))
+    def Start(self, sender=None, conn=None, path=None, reply=None, error=None):
+        """Start a job by name. Does not enable/disable the job."""
+        self.idle.ping()
+        job = self.get_job(path)
+        log.debug('Start called on {0}'.format(job.name))
+        self._run_authorized(sender, conn, job.name, job.start, (),
+                reply, error, lambda: self._invalidate([job.name], info=False))
+    
+    @DBusMethod(DBUS_JOB_IFACE, in_signature='', out_signature='',
+                sender_keyword='sender', connection_keyword='conn',
+                rel_path_keyword='path', async_callbacks=('reply', 'error'))
+    def Stop(self, sender=None, conn=None, path=None, reply=None, error=None):
+        """Stop a job by name. Does not enable/disable the job."""
+        self.idle.ping()
+        job = self.get_job(path)
+        log.debug('Stop called on {0}'.format(job.name))
+        self._run_authorized(sender, conn, job.name, job.stop, (),
+                reply, error, lambda: self._invalidate([job.name], info=False))
+    
+    @DBusMethod(DBUS_JOB_IFACE, in_signature='b', out_signature='',
+                sender_keyword='sender', connection_keyword='conn',
+                rel_path_keyword='path', async_callbacks=('reply', 'error'))
+    def SetAutomatic(self, auto, sender=None, conn=None, path=None,
+                     reply=None, error=None):
+        """Make a job automatic or manual. Does not change state."""
+        self.idle.ping()
+        job = self.get_job(path)
+        log.debug('SetAutomatic ({1}) called on {0}'.format(job.name, auto))
+        self._run_authorized(sender, conn, job.name, job.set_automatic, (auto,),
+                reply, error, lambda: self._invalidate([job.name], state=False))
+    
+    @DBusMethod(DBUS_JOB_IFACE, in_signature='s',
+                out_signature='a(ssssa(ss)a{ss})',
+                sender_keyword='sender', connection_keyword='conn',
+                rel_path_keyword='path')
+    def GetSettings(self, lang, sender=None, conn=None, path=None):
+        """
+        Return a job's available settings and constraints.
+        
+        Takes a single argument (locale) used to determine what language the
+        descriptions should be sent in. If unknown, use an empty string.
+        
+        Returns list of struct settings (
+            string name
+            string type
+            string description
+            string current-value
+            list of struct values (
+                string name
+                string description
+            )
+            dict constraints {
+                key: string type
+                value: string value
+            }
+        )
+        """
+        self.idle.ping()
+        job = self.get_job(path)
+        log.debug('GetSettings ({1}) called on {0}'.format(job.name, lang))
+        return job.get_settings(lang)
+    
+    @DBusMethod(DBUS_JOB_IFACE, in_signature='a{ss}', out_signature='',
+                sender_keyword='sender', connection_keyword='conn',
+                rel_path_keyword='path', async_callbacks=('reply', 'error'))
+    def SetSettings(self, settings, sender=None, conn=None, path=None,
+                    reply=None, error=None):
+        """Change a job's settings after validating."""
+        self.idle.ping()
+        job = self.get_job(path)
+        log.debug('SetSettings called on {0}'.format(job.name))
+        self._run_authorized(sender, conn, job.name, job.set_settings, (settings,),
+                reply, error, lambda: self._invalidate([job.name]))
+    
+    @DBusMethod(DBUS_JOB_IFACE, in_signature='ss', out_signature='b',
+                sender_keyword='sender', connection_keyword='conn',
+                rel_path_keyword='path')
+    def ValidateSetting(self, setting, value, sender=None, conn=None, path=None):
+        """Verify a setting's value is valid."""
+        self.idle.ping()
+        job = self.get_job(path)
+        log.debug('ValidateSetting ({1}) called on {0}'.format(job.name, setting))
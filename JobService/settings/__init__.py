@@ -14,10 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import logging
-from os.path import exists
-from JobService.settings.parser import SettingParser
+from threading import Lock
+from JobService.settings.parser import SettingParser, compile_sls, \
+        write_changes, run_helpers, save_files, restore_files
 from JobService.settings import types
+from JobService.settings.helpers import stop_helpers
+from JobService import cache
 import JobService
 
 TYPE_MAP = {
@@ -36,28 +40,42 @@ TYPE_MAP = {
 
 log = logging.getLogger('sls')
 
+COMPILED_VERSION = 2    # bump whenever the output of compile_sls changes
+
+_dirs = {}          # SLS directory: (mtime, set of file names)
+_compiled = None    # SLS filename: (size, mtime, compiled SLS)
+_dirty = False      # whether _compiled has changed since it was saved
+_lock = Lock()
+
 #XXX: this may be useful as a dictionary subclass, if done right.
 
 class ServiceSettings:
     """Service-level settings (SLS) for a single service."""
     
-    def __init__(self, jobname):
+    def __init__(self, jobname, filename=None):
+        """
+        Load the SLS for jobname. If filename is given (for example, from a
+        snapshot), the usual locations aren't searched.
+        """
         self.jobname = jobname
         if '/' in jobname:
             basename = jobname.split('/')[0]
         else:
             basename = jobname
-        self.filename = ''
-        for loc in (JobService.SLS_LOCAL, JobService.SLS_SYSTEM, JobService.SLS_DEFAULT):
+        self.filename = filename or ''
+        locations = () if filename else (JobService.SLS_LOCAL,
+                JobService.SLS_SYSTEM, JobService.SLS_DEFAULT)
+        for loc in locations:
             if not loc:
                 continue
             self.filename = loc.format(basename)
-            if exists(self.filename):
+            if _sls_exists(self.filename):
                 log.debug('Using ' + self.filename)
                 break
         self.settingnames = []
         self.settings = {}
-        self.parser = SettingParser(self.filename, jobname)
+        self.parser = SettingParser(self.filename, jobname,
+                _load_compiled(self.filename))
     
     def get_all_settings(self):
         if not self.settingnames:
@@ -65,14 +83,75 @@ class ServiceSettings:
         return self.settingnames
     
     def get_setting(self, name, lang=''):
-        setting = self.parser.get_setting(name, lang)
-        inst = TYPE_MAP[setting[1]](setting[4], setting[5])
-        self.settings[name] = inst
-        return setting
+        return self.get_settings([name], lang)[0]
+    
+    def get_settings(self, names, lang=''):
+        """Return the details of several settings, reading each file once."""
+        settings = self.parser.get_settings(names, lang)
+        for setting in settings:
+            inst = TYPE_MAP[setting[1]](setting[4], setting[5])
+            self.settings[setting[0]] = inst
+        return settings
     
     def set_setting(self, name, value):
         self.parser.set_setting(name, value)
     
+    def set_settings(self, changes):
+        """Store a list of (name, value) changes, rewriting each file once."""
+        self.parser.set_settings(changes)
+    
+    def add_changes(self, changes, files, order, helpers):
+        """Gather changes to be written by write_changes with others."""
+        self.parser.add_changes(changes, files, order, helpers)
+    
     def validate_setting(self, name, value):
+        if name not in self.settings:
+            self.get_setting(name)
         self.settings[name].validate(value)
+        self.parser.check_value(name, value)
         return True
+
+def save_compiled():
+    """Store compiled SLS files for the next start, if any were compiled."""
+    global _dirty
+    with _lock:
+        if _dirty:
+            cache.save_snapshot('sls', COMPILED_VERSION, _compiled)
+            _dirty = False
+
+def _sls_exists(filename):
+    """
+    Check for an SLS file in a listing of its directory, which is only
+    made again when the directory's mtime changes.
+    """
+    directory, name = os.path.split(filename)
+    try:
+        mtime = os.stat(directory or '.').st_mtime
+    except OSError:
+        mtime = None
+    with _lock:
+        if directory not in _dirs or _dirs[directory][0] != mtime:
+            try:
+                _dirs[directory] = (mtime, set(os.listdir(directory or '.')))
+            except OSError:
+                _dirs[directory] = (mtime, set())
+        return name in _dirs[directory][1]
+
+def _load_compiled(filename):
+    """
+    Return the compiled form of an SLS file, compiling it only if it has
+    changed since it was last compiled (in this or an earlier run).
+    """
+    global _compiled, _dirty
+    st = os.stat(filename)
+    with _lock:
+        if _compiled is None:
+            _compiled = cache.load_snapshot('sls', COMPILED_VERSION) or {}
+        entry = _compiled.get(filename)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+    compiled = compile_sls(filename)
+    with _lock:
+        _compiled[filename] = (st.st_size, st.st_mtime, compiled)
+        _dirty = True
+    return compiled
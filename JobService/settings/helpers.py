@@ -0,0 +1,141 @@
+# This file is part of jobservice.
+# Copyright 2010 Jacob Peddicord <jpeddicord@ubuntu.com>
+#
+# jobservice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jobservice is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+from time import time
+from select import select, error as SelectError
+from threading import Lock
+from subprocess import Popen, PIPE
+from JobService.settings.types import ValidationError
+from JobService.util import wait_until
+
+log = logging.getLogger('sls')
+
+HELPER_TIMEOUT = 10     # seconds a persistent helper may take to answer
+STOP_TIMEOUT = 2    # seconds a helper gets to exit before it is signalled
+
+_helpers = {}   # command: Helper, for helpers marked persist="true"
+_lock = Lock()
+
+class Helper:
+    """
+    A long-lived external helper, started once and reused for every get
+    and set. Requests are single lines on the helper's stdin:
+        
+        get             the helper replies with the same output it would
+                        give when run for a get, then a line with only "."
+        set <line>      the helper stores <line>, as it would have read it
+                        on stdin for a set, and replies with a "." line
+    """
+    
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+        self.lock = Lock()
+    
+    def request(self, line):
+        """Send a request, returning the reply without its end marker."""
+        with self.lock:
+            if not self.proc or self.proc.poll() is not None:
+                log.debug('Starting helper: {0}'.format(self.cmd))
+                self.proc = Popen(self.cmd, shell=True, stdin=PIPE,
+                                  stdout=PIPE, close_fds=True)
+            try:
+                self.proc.stdin.write(line + '\n')
+                self.proc.stdin.flush()
+                return self._read_reply()
+            except (IOError, OSError, ValueError, SelectError):
+                self.stop()
+                raise
+    
+    def _read_reply(self):
+        """
+        Read a reply up to its end marker, giving up if the helper takes
+        longer than HELPER_TIMEOUT seconds.
+        """
+        fd = self.proc.stdout.fileno()
+        deadline = time() + HELPER_TIMEOUT
+        data = ''
+        while True:
+            if data.startswith('.\n'):
+                return ''
+            end = data.find('\n.\n')
+            if end >= 0:
+                return data[:end+1]
+            remaining = deadline - time()
+            if remaining <= 0 or not select([fd], [], [], remaining)[0]:
+                raise IOError('Helper timed out: {0}'.format(self.cmd))
+            out = os.read(fd, 4096)
+            if not out:
+                raise IOError('Helper exited: {0}'.format(self.cmd))
+            data += out
+    
+    def stop(self):
+        """
+        Close the helper's stdin so it exits, terminating it if it hasn't
+        after STOP_TIMEOUT seconds, and killing it if that doesn't work.
+        """
+        proc, self.proc = self.proc, None
+        if not proc or proc.poll() is not None:
+            return
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        exited = lambda: proc.poll() is not None
+        for end in (proc.terminate, proc.kill):
+            if wait_until(exited, STOP_TIMEOUT):
+                return
+            log.warn('Helper did not exit: {0}'.format(self.cmd))
+            try:
+                end()
+            except OSError:
+                pass
+        proc.wait()
+
+def run_get(cmd, persist=False):
+    """Return the output of a get helper."""
+    if persist:
+        return _get_helper(cmd).request('get')
+    proc = Popen(cmd, shell=True, stdout=PIPE)
+    return proc.communicate()[0]
+
+def run_set(cmd, data, persist=False):
+    """Give a line of data to a set helper."""
+    if persist:
+        # a newline would end the request early
+        if '\n' in data:
+            raise ValidationError('Value can not span lines.')
+        _get_helper(cmd).request('set ' + data)
+        return
+    proc = Popen(cmd, shell=True, stdin=PIPE)
+    proc.communicate(data)
+
+def stop_helpers():
+    """Stop all long-lived helpers, ie. when the daemon exits."""
+    with _lock:
+        helpers = _helpers.values()
+        _helpers.clear()
+    for helper in helpers:
+        with helper.lock:
+            helper.stop()
+
+def _get_helper(cmd):
+    with _lock:
+        if cmd not in _helpers:
+            _helpers[cmd] = Helper(cmd)
+        return _helpers[cmd]
@@ -14,144 +14,319 @@
 # You should have received a copy of the GNU General Public License
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
-from os import rename
+import os
+import logging
+from stat import S_IMODE
 from cStringIO import StringIO
-from subprocess import Popen, PIPE
 from xml.etree.cElementTree import ElementTree
+from JobService.settings.helpers import run_get, run_set
+from JobService.settings.types import ValidationError
+from JobService.util import parallel_map
 
+log = logging.getLogger('sls')
+
+HELPER_WORKERS = 4  # get helpers run at once by get_settings
+
+def compile_sls(filename):
+    """
+    Read an SLS file into plain lists and dictionaries, which are much
+    quicker to load again than the XML:
+    {'names': [setting names], 'settings': {name: details}}
+    """
+    tree = ElementTree()
+    tree.parse(filename)
+    names = []
+    settings = {}
+    for e in tree.findall('setting'):
+        name = e.get('name')
+        data = e.find('data')
+        parse = []
+        for p in e.findall('data/parse'):
+            parse.append({'text': p.text, 'file': p.get('file'),
+                          'after': p.get('after'), 'get': p.get('get'),
+                          'set': p.get('set'),
+                          'persist': p.get('persist') == 'true'})
+        values = []
+        for v in e.findall('values/value'):
+            values.append((v.get('name'), v.findtext('description', ''),
+                           v.findtext('raw')))
+        vals = e.find('values')
+        settings[name] = {
+            'type': e.get('type'),
+            'description': e.findtext('description'),
+            'data': data != None,
+            'fixed': data.get('val') if data != None else None,
+            'parse': parse,
+            'values': values,
+            'constraints': dict(vals.attrib) if vals != None else {},
+        }
+        names.append(name)
+    return {'names': names, 'settings': settings}
 
 class SettingParser:
-    """XML and file parser for SLS."""
+    """Parser for the files SLS settings are stored in."""
     
-    def __init__(self, filename, jobname):
+    def __init__(self, filename, jobname, compiled=None):
+        """
+        Load settings from SLS 'filename', or from 'compiled', the result
+        of compile_sls on it.
+        """
         self.filename = filename
         self.jobname = jobname
-        self.tree = ElementTree()
-        self.tree.parse(self.filename)
-        self._selements = {}
+        if compiled is None:
+            compiled = compile_sls(filename)
+        self.names = compiled['names']
+        self.settings = compiled['settings']
     
     def get_all_settings(self):
         """Return a list of setting names available in this file."""
-        lst = []
-        for e in self.tree.findall('setting'):
-            name = e.get('name')
-            self._selements[name] = e
-            lst.append(name)
-        return lst
+        return list(self.names)
     
     def get_setting(self, name, lang=''):
         """Return details of a specific setting by name in the format:
         (name, type, description, current, possible[], constraints{})
         """
-        ele = self._selements[name]
-        # current value
-        raw = ''
-        data = ele.find('data')
-        if data != None:
-            fixed = data.get('val')
-            if fixed:
-                raw = fixed
-            else:
-                # find the first source we can obtain a value from
-                for p in ele.findall('data/parse'):
-                    parse = p.text.replace('%n', name)
-                    parse = parse.replace('%j', self.jobname)
-                    # load from file
-                    if p.get('file'):
-                        prescan = p.get('after')
-                        with open(p.get('file')) as f:
-                            raw = self._raw_value(parse, f, prescan=prescan)
-                        break
-                    # load from external helper
-                    elif p.get('get'):
-                        cmd = p.get('get').replace('%j', self.jobname)
-                        proc = Popen(cmd, shell=True, stdout=PIPE)
-                        sio = StringIO(proc.communicate()[0])
-                        raw = self._raw_value(parse, sio)
-                        break
+        return self.get_settings([name], lang)[0]
+    
+    def get_settings(self, names, lang=''):
+        """
+        Return get_setting details for several settings. Each file is read
+        only once, for all of the settings stored in it, and each distinct
+        get helper is run only once, alongside the others.
+        """
+        raws = {}
+        files = {}  # filename: {name: (parse, prescan)}
+        helpers = {}    # (command, persist): [(name, parse)]
+        for name in names:
+            setting = self.settings[name]
+            raws[name] = ''
+            if not setting['data']:
+                continue
+            if setting['fixed']:
+                raws[name] = setting['fixed']
+                continue
+            p, parse = self._source(name)
+            # load from file
+            if p and p['file']:
+                files.setdefault(p['file'], {})[name] = (parse, p['after'])
+            # load from external helper
+            elif p:
+                cmd = p['get'].replace('%j', self.jobname)
+                helpers.setdefault((cmd, p['persist']), []).append(
+                        (name, parse))
+        for filename, parses in files.iteritems():
+            with open(filename) as f:
+                raws.update(self._raw_values(parses, f))
+        keys = helpers.keys()
+        outputs = parallel_map(lambda key: run_get(*key), keys,
+                HELPER_WORKERS)
+        for key, output in zip(keys, outputs):
+            parses = dict((name, (parse, None)) for name, parse in helpers[key])
+            raws.update(self._raw_values(parses, StringIO(output)))
+        return [self._details(name, raws[name]) for name in names]
+    
+    def _source(self, name):
+        """
+        Return the first parse rule of a setting we can obtain a value from,
+        along with its pattern, or (None, None).
+        """
+        for p in self.settings[name]['parse']:
+            if p['file'] or p['get']:
+                parse = p['text'].replace('%n', name)
+                return (p, parse.replace('%j', self.jobname))
+        return (None, None)
+    
+    def _details(self, name, raw):
+        """Return the details of a setting with raw value 'raw'."""
+        setting = self.settings[name]
         # get available values
         values = []
         current = raw
-        for v in ele.findall('values/value'):
-            values.append((v.get('name'), v.findtext('description', '')))
+        for vname, description, vraw in setting['values']:
+            values.append((vname, description))
             # value translation
-            if v.findtext('raw') == raw:
-                current = v.get('name')
-        vals = ele.find('values')
-        constraints = vals.attrib if vals != None else {}
-        return (name, ele.get('type'), ele.findtext('description'),
-                current, values, constraints)
+            if vraw == raw:
+                current = vname
+        return (name, setting['type'], setting['description'],
+                current, values, setting['constraints'])
+    
+    def check_value(self, name, value):
+        """Reject values that can't be passed on to a setting's helpers."""
+        for p in self.settings[name]['parse']:
+            if p['set'] and p['persist'] and '\n' in value:
+                raise ValidationError('Value can not span lines.')
     
     def set_setting(self, name, value):
-        ele = self._selements[name]
-        # don't do anything with an empty data element
-        data = ele.find('data')
-        if not len(data):
-            return
-        # translate the value into something for the file
-        newval = value
-        for v in ele.findall('values/value'):
-            if v.get('name') == value:
-                newval = v.findtext('raw')
-                break
-        # write out values
-        for p in data.findall('parse'):
-            parse = p.text.replace('%n', name)
-            parse = parse.replace('%j', self.jobname)
-            # write to file
-            if p.get('file'):
-                filename = p.get('file')
-                prescan = p.get('after')
-                # write the new values
-                read = open(filename)
-                write = open('{0}.new'.format(filename), 'w')
-                self._raw_value(parse, read, write, newval, prescan)
-                write.close()
-                read.close()
-                # replace the original with backup
-                rename(read.name, '{0}~'.format(read.name))
-                rename(write.name, read.name)
-            # send to an external program for processing
-            elif p.get('set'):
-                cmd = p.get('set').replace('%j', self.jobname)
-                proc = Popen(cmd, shell=True, stdin=PIPE)
-                proc.communicate(parse.replace('%s', newval))
+        self.set_settings([(name, value)])
     
-    def _raw_value(self, parse, read, write=None, newval=None, prescan=None):
+    def set_settings(self, changes):
         """
-        Read or write (if write is not None) a raw value to a conf file.
-        read & write are file objects.
-        
-        If the setting line has been commented, it will still be read normally.
-        On write, the comment will be removed. Default settings are assumed
-        to be commented out, so when changing them we'll need to uncomment.
+        Store a list of (name, value) changes. All changes to a file are
+        made in a single pass, and the file is replaced atomically once.
+        """
+        files = {}
+        order = []
+        helpers = []
+        self.add_changes(changes, files, order, helpers)
+        write_changes(files, order)
+        run_helpers(helpers)
+    
+    def add_changes(self, changes, files, order, helpers):
+        """
+        Add (name, value) changes stored in files to 'files' and 'order'
+        for write_changes, and the ones given to set helpers to 'helpers'
+        for run_helpers. This lets changes to several jobs sharing a file
+        be written in one pass.
+        """
+        for name, value in changes:
+            setting = self.settings[name]
+            # don't do anything with an empty data element
+            if not setting['parse']:
+                continue
+            # translate the value into something for the file
+            newval = value
+            for vname, description, vraw in setting['values']:
+                if vname == value:
+                    newval = vraw
+                    break
+            # write out values
+            for p in setting['parse']:
+                parse = p['text'].replace('%n', name)
+                parse = parse.replace('%j', self.jobname)
+                # write to file
+                if p['file']:
+                    if p['file'] not in files:
+                        files[p['file']] = {}
+                        order.append(p['file'])
+                    key = (self.jobname, name, parse)
+                    files[p['file']][key] = (parse, p['after'], newval)
+                # send to an external program for processing
+                elif p['set']:
+                    cmd = p['set'].replace('%j', self.jobname)
+                    helpers.append((cmd, parse.replace('%s', newval),
+                                    p['persist']))
+    
+    def _raw_values(self, parses, read):
+        """
+        Read several raw values from a conf file in a single pass.
+        parses maps keys to (parse, prescan), where parse is the setting's
+        pattern with %s in place of the value, and the values found are
+        returned by key ('' if not found).
         
-        If "prescan" is set, will not begin scanning until the string provided
-        has been passed.
+        Commented setting lines are read normally, as default settings are
+        assumed to be commented out. If prescan is set, scanning for that
+        value only begins once a line containing prescan has been passed.
         """
-        assert parse
-        before, after = parse.strip().split('%s')
-        value = False
-        scanning = False if prescan else True
+        values = {}
+        pending = {}
+        for key, (parse, prescan) in parses.iteritems():
+            before, after = parse.strip().split('%s')
+            values[key] = ''
+            pending[key] = [before, after, prescan]
         for line in read:
-            if not scanning and prescan:
-                if line.find(prescan) != -1:
-                    scanning = True
-            beforepos = line.find(before)
-            # the last check is to make sure this is the right line,
-            # but we only perform it if we _might_ have it for speed.
-            if scanning and beforepos >= 0 and line.lstrip(' #;\t').find(before) == 0:
-                if write:
-                    data = ''.join((line[:beforepos], before, newval, after, '\n'))
-                    write.write(data.lstrip('#;'))
-                else:
+            if not pending:
+                break
+            for key in pending.keys():
+                before, after, prescan = pending[key]
+                if prescan:
+                    if line.find(prescan) == -1:
+                        continue
+                    pending[key][2] = None
+                beforepos = line.find(before)
+                # the last check is to make sure this is the right line,
+                # but we only perform it if we _might_ have it for speed.
+                if beforepos >= 0 and line.lstrip(' #;\t').find(before) == 0:
                     start = beforepos + len(before)
                     if after:
-                        value = line[start:line.find(after, start)]
+                        values[key] = line[start:line.find(after, start)]
                     else:
-                        value = line[start:len(line)-1] # \n at the end
-                    return value
+                        values[key] = line[start:len(line)-1] # \n at the end
+                    del pending[key]
+        return values
+
+def write_changes(files, order):
+    """
+    Rewrite each file in order with the rules gathered for it by
+    SettingParser.add_changes: {filename: {key: (parse, prescan, value)}}
+    """
+    for filename in order:
+        _rewrite(filename, files[filename])
+
+def run_helpers(helpers):
+    """Give each set helper its line from add_changes, in order."""
+    for cmd, data, persist in helpers:
+        run_set(cmd, data, persist)
+
+def save_files(filenames):
+    """Return the contents of files about to be rewritten, by name."""
+    saved = {}
+    for filename in filenames:
+        with open(filename) as f:
+            saved[filename] = f.read()
+    return saved
+
+def restore_files(saved):
+    """Put back files saved with save_files exactly as they were."""
+    for filename, data in saved.iteritems():
+        st = os.stat(filename)
+        newname = '{0}.new'.format(filename)
+        with open(newname, 'w') as write:
+            os.fchmod(write.fileno(), S_IMODE(st.st_mode))
+            os.fchown(write.fileno(), st.st_uid, st.st_gid)
+            write.write(data)
+            write.flush()
+            os.fsync(write.fileno())
+        os.rename(newname, filename)
+
+def _rewrite(filename, rules):
+    """
+    Write new values into a file, keeping the original as a backup.
+    The new contents are synced to disk before they replace the file.
+    """
+    st = os.stat(filename)
+    newname = '{0}.new'.format(filename)
+    with open(filename) as read:
+        with open(newname, 'w') as write:
+            os.fchmod(write.fileno(), S_IMODE(st.st_mode))
+            os.fchown(write.fileno(), st.st_uid, st.st_gid)
+            _write_values(rules, read, write)
+            write.flush()
+            os.fsync(write.fileno())
+    # keep the original as a backup without copying it
+    backup = '{0}~'.format(filename)
+    try:
+        if os.path.lexists(backup):
+            os.remove(backup)
+        os.link(filename, backup)
+    except OSError, e:
+        log.warn('Unable to back up {0}: {1}'.format(filename, e))
+    os.rename(newname, filename)
+
+def _write_values(rules, read, write):
+    """
+    Copy a conf file from read to write, replacing several values in a
+    single pass. rules maps keys to (parse, prescan, new value).
+    """
+    pending = []
+    for key, (parse, prescan, newval) in rules.iteritems():
+        before, after = parse.strip().split('%s')
+        pending.append([before, after, prescan, newval])
+    for line in read:
+        replaced = False
+        for rule in pending:
+            before, after, prescan, newval = rule
+            if prescan:
+                if line.find(prescan) == -1:
+                    continue
+                rule[2] = None
+            if replaced:
                 continue
-            if write:
-                write.write(line)
-        return ''
+            beforepos = line.find(before)
+            # the last check is to make sure this is the right line,
+            # but we only perform it if we _might_ have it for speed.
+            if beforepos >= 0 and line.lstrip(' #;\t').find(before) == 0:
+                data = ''.join((line[:beforepos], before, newval, after, '\n'))
+                write.write(data.lstrip('#;'))
+                replaced = True
+        if not replaced:
+            write.write(line)
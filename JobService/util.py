@@ -14,12 +14,24 @@
 # You should have received a copy of the GNU General Public License
 # along with jobservice.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import logging
-from time import time
-from glib import timeout_add_seconds
+from string import ascii_letters, digits, hexdigits
+from time import time, sleep
+from threading import Thread, Lock, Condition
+from Queue import Queue, Empty
+from glib import timeout_add_seconds, idle_add
+from dbus import DBusException
+try:
+    import gio
+except ImportError:
+    gio = None
 
 log = logging.getLogger('jobservice')
 
+NAME_CHARS = ascii_letters + digits    # left as they are in escaped names
+REPLY_TIMEOUT = 30  # seconds CallBatch waits for its reply handlers
+
 class IdleTimeout:
     """
     Keeps track of the time since last use.
@@ -58,4 +70,231 @@ def dbus_safe_name(unsafe):
             safe += '_{0:02x}'.format(ord(ch))
     return safe
 
+def dbus_unsafe_name(safe):
+    """
+    Reverse dbus_safe_name, returning the original name.
+    Raises ValueError if the name is not a valid escaped name.
+    """
+    unsafe = ''
+    i = 0
+    while i < len(safe):
+        if safe[i] == '_':
+            escape = safe[i+1:i+3]
+            if len(escape) != 2 or escape.strip(hexdigits):
+                raise ValueError('Invalid escape in name: {0!r}'.format(safe))
+            unsafe += chr(int(escape, 16))
+            i += 3
+        elif safe[i] in NAME_CHARS:
+            unsafe += safe[i]
+            i += 1
+        else:
+            raise ValueError('Invalid character in name: {0!r}'.format(safe))
+    return unsafe
+
+def parallel_map(func, items, workers=4):
+    """
+    Return [func(item) for item in items], running up to 'workers' calls
+    at once in separate threads. Results are kept in the order of items.
+    
+    If any call raised, the first exception (in item order) is re-raised
+    once every call has finished.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    queue = Queue()
+    for pair in enumerate(items):
+        queue.put(pair)
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors[i] = sys.exc_info()
+    threads = [Thread(target=worker) for n in range(min(workers, len(items)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    for err in errors:
+        if err:
+            raise err[0], err[1], err[2]
+    return results
+
+def watch_directory(path, callback):
+    """
+    Call callback(filename) whenever a file in directory 'path' is created,
+    removed or changed. Returns a monitor that must be kept around for as
+    long as the watch should last, or None if monitoring is unavailable.
+    """
+    if not gio:
+        log.debug('gio not available, not watching ' + path)
+        return None
+    events = (gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT,
+              gio.FILE_MONITOR_EVENT_DELETED,
+              gio.FILE_MONITOR_EVENT_CREATED,
+              gio.FILE_MONITOR_EVENT_ATTRIBUTE_CHANGED)
+    def changed(monitor, changed_file, other_file, event):
+        if event in events:
+            callback(changed_file.get_path())
+    try:
+        monitor = gio.File(path).monitor_directory()
+    except gio.Error:
+        return None
+    monitor.connect('changed', changed)
+    return monitor
+
+def wait_until(done, timeout):
+    """
+    Call done() until it returns True, pausing a little longer each time,
+    for at most timeout seconds. Returns False if it timed out.
+    """
+    deadline = time() + timeout
+    delay = 0.01
+    while not done():
+        if time() > deadline:
+            return False
+        sleep(delay)
+        delay = min(delay * 2, 0.2)
+    return True
+
+class CallBatch:
+    """
+    Sends many D-Bus calls to a service before waiting on any of the
+    replies, so they are all in flight at once. Replies are handled by
+    whichever thread dispatches them, and wait only returns once every
+    handler has run, so this works both at startup and from worker threads
+    while the main loop is running.
+    """
+    
+    def __init__(self, bus, service):
+        self.bus = bus
+        self.service = service
+        self.pending = []
+        self.error = None
+        self.calls = 0
+        self.waiting = 0    # calls whose handlers haven't run yet
+        self.cond = Condition()
+    
+    def call(self, path, iface, method, signature, args, handler):
+        """Send a method call. handler is given the reply's values."""
+        with self.cond:
+            self.waiting += 1
+        def replied(*values):
+            try:
+                handler(*values)
+            finally:
+                self._handled()
+        self.pending.append(self.bus.call_async(self.service, path,
+                iface, method, signature, args, replied, self._error,
+                require_main_loop=False))
+        self.calls += 1
+    
+    def wait(self):
+        """Wait for all replies, raising the first error if there was one."""
+        for pending in self.pending:
+            pending.block()
+        self.pending = []
+        # the main loop may still be running some of the handlers
+        deadline = time() + REPLY_TIMEOUT
+        with self.cond:
+            while self.waiting and time() < deadline:
+                self.cond.wait(deadline - time())
+            if self.waiting:
+                self.waiting = 0
+                self.error = self.error or DBusException(
+                        'Timed out waiting for replies.')
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+    
+    def _error(self, e):
+        if not self.error:
+            self.error = e
+        self._handled()
+    
+    def _handled(self):
+        with self.cond:
+            self.waiting -= 1
+            self.cond.notify_all()
+
+def store_reply(d, key):
+    """Return a CallBatch reply handler that stores its value in d[key]."""
+    def handler(value):
+        d[key] = value
+    return handler
+
+class WorkerPool:
+    """
+    Runs functions in a fixed number of threads so that slow operations
+    don't hold up the main loop. Results are passed back to callbacks in
+    the main loop. Tasks sharing a key are run one at a time, in the order
+    they were submitted.
+    """
+    
+    def __init__(self, workers=4):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.busy = set()   # keys of the tasks running
+        self.waiting = []   # tasks waiting on a busy key, oldest first
+        for n in range(workers):
+            t = Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+    
+    def submit(self, key, func, args=(), callback=None, errback=None):
+        """
+        Call func(*args) in a worker, then callback(result) or
+        errback(exception) from the main loop. The key can also be a list
+        of keys, ie. for a task touching several jobs; it then waits until
+        none of them are in use.
+        """
+        if isinstance(key, list):
+            keys = set(key)
+        else:
+            keys = set([key])
+        with self.lock:
+            self.waiting.append((keys, func, args, callback, errback))
+            self._schedule()
+    
+    def _schedule(self):
+        """Queue the waiting tasks whose keys are free. Needs the lock."""
+        blocked = set(self.busy)
+        waiting = []
+        for task in self.waiting:
+            # an earlier task waiting on a key goes first
+            if task[0] & blocked:
+                waiting.append(task)
+            else:
+                self.busy |= task[0]
+                self.queue.put(task)
+            blocked |= task[0]
+        self.waiting = waiting
+    
+    def _work(self):
+        while True:
+            keys, func, args, callback, errback = self.queue.get()
+            try:
+                result = func(*args)
+            except Exception, e:
+                if errback:
+                    idle_add(_call_once, errback, e)
+            else:
+                if callback:
+                    idle_add(_call_once, callback, result)
+            # let the next tasks for these keys go
+            with self.lock:
+                self.busy -= keys
+                self._schedule()
 
+def _call_once(func, *args):
+    """Call func from an idle handler without it being repeated."""
+    func(*args)
+    return False